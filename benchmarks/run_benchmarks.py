@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+import synthetic_longeval
+
+ROOT = Path(__file__).resolve().parent.parent
+# The stages of a subproject in the order in which they depend on each other
+SUBPROJECT_STAGES = {
+    "pyterrier-first-stage": ["indexing", "tokenisation", "retrieval"],
+    "pyterrier-keyqueries": ["keyquery-indexing", "keyquery-search"],
+    "intent-classification": ["intent-preprocessing", "snorkel-labelling"],
+}
+STAGES = [stage for stages in SUBPROJECT_STAGES.values() for stage in stages]
+
+
+def benchmark_indexing(state):
+    from baseline import get_index
+
+    state["index"] = get_index(state["snapshot"], state["directory"] / "indexes" / state["snapshot"].get_snapshot())
+    return state["snapshot"].docs_count()
+
+
+def benchmark_tokenisation(state):
+    from longeval_common.retrieval import query_tokens, tokenise_queries
+
+    query_tokens.clear()
+    state["topics"]["query"] = tokenise_queries(state["topics"]["query"].tolist())
+    return len(state["topics"])
+
+
+def benchmark_retrieval(state):
+    import pyterrier as pt
+    from longeval_common.retrieval import retrieve
+
+    retriever = pt.terrier.Retriever(state["index"], wmodel="PL2", threads=state["threads"])
+    return len(retrieve(retriever, state["topics"]))
+
+
+def benchmark_keyquery_indexing(state):
+    from keyqueries import get_index
+
+    state["keyquery_index"] = get_index(state["snapshot"], state["directory"] / "keyquery-indexes" / state["snapshot"].get_snapshot())
+    return state["snapshot"].docs_count()
+
+
+def benchmark_keyquery_search(state):
+    from keyqueries import get_keyqueries
+
+    index_directory = state["directory"] / "keyquery-indexes" / state["snapshot"].get_snapshot()
+    keyqueries = get_keyqueries(state["snapshot"], state["keyquery_index"], index_directory, state["threads"])
+    return sum(1 for i in keyqueries.values() if i)
+
+
+def benchmark_intent_preprocessing(state):
+    from preprocessing_train import remove_duplicate_authors, stream_group_by_query
+
+    state["grouped_queries"] = remove_duplicate_authors(stream_group_by_query(state["training_snapshot"]))
+    return len(state["grouped_queries"])
+
+
+def benchmark_snorkel_labelling(state):
+    from snorkel_labelling_train import lfs
+    from vectorised_labelling import apply_lfs
+
+    return len(apply_lfs(state["grouped_queries"], lfs))
+
+
+def run_stage(stage, state):
+    """
+    Time a stage. A failing stage (e.g., because Java or snorkel is not installed) is recorded with its error
+    and does not stop the stages that do not depend on it.
+    """
+    start = perf_counter()
+    try:
+        items = globals()[f"benchmark_{stage.replace('-', '_')}"](state)
+        seconds = perf_counter() - start
+        return {"stage": stage, "seconds": seconds, "items": items, "items_per_second": items / seconds if seconds else None}
+    except Exception as e:
+        traceback.print_exc()
+        return {"stage": stage, "seconds": perf_counter() - start, "error": f"{type(e).__name__}: {e}"}
+
+
+def run_subproject(subproject, stages, config, directory):
+    """
+    Runs the stages of a subproject in its own worker process. The subprojects are no packages and have modules
+    with the same names, so only the directory of this subproject is put on the path and is the working directory.
+    """
+    os.chdir(ROOT / subproject)
+    sys.path.insert(0, str(ROOT / subproject))
+    import pandas as pd
+
+    start = perf_counter()
+    collection = synthetic_longeval.load(config["documents"], config["snapshots"], config["doc_overlap"], config["queries"], config["query_repetition"], config["seed"])
+    print(f"Generated the synthetic collection for {subproject} in {perf_counter() - start:.1f}s")
+
+    # the last snapshot is processed like a test snapshot, its prior snapshots provide the relevance feedback
+    snapshot = collection.get_datasets()[-1]
+    state = {
+        "snapshot": snapshot,
+        "training_snapshot": collection.get_datasets()[0],
+        "directory": directory,
+        "threads": config["threads"],
+        "topics": pd.DataFrame([{"qid": i.query_id, "query": i.default_text()} for i in snapshot.queries_iter()]),
+    }
+    results = []
+    for stage in stages:
+        result = run_stage(stage, state)
+        results.append(result)
+        print(f"{stage}\t{result['seconds']:.3f}s\t" + (f"{result['items']} items" if "error" not in result else result["error"]))
+
+    for index in ["index", "keyquery_index"]:
+        if index in state:
+            state[index].close()
+    return results
+
+
+@click.command()
+@click.option("--documents", type=int, default=10000, help="The number of documents per snapshot.")
+@click.option("--snapshots", type=int, default=3, help="The number of snapshots.")
+@click.option("--doc-overlap", type=click.FloatRange(0, 1), default=0.8, help="The share of the documents of a snapshot that are also in the next snapshot.")
+@click.option("--queries", type=int, default=500, help="The number of queries per snapshot.")
+@click.option("--query-repetition", type=click.FloatRange(0, 1), default=0.5, help="The share of the queries of a snapshot that repeat a query of a prior snapshot.")
+@click.option("--seed", type=int, default=0, help="The seed of the synthetic collection.")
+@click.option("--threads", type=int, default=1, help="The number of retrieval threads.")
+@click.option("--stage", "stages", type=click.Choice(STAGES), multiple=True, default=STAGES, help="The stages to benchmark, all by default.")
+@click.option("--output", type=Path, default=None, help="The JSON file for the results, by default a new file in benchmarks/results.")
+def main(documents, snapshots, doc_overlap, queries, query_repetition, seed, threads, stages, output):
+    config = {
+        "documents": documents, "snapshots": snapshots, "doc_overlap": doc_overlap, "queries": queries,
+        "query_repetition": query_repetition, "seed": seed, "threads": threads,
+    }
+
+    results = []
+    with TemporaryDirectory() as directory:
+        for subproject, subproject_stages in SUBPROJECT_STAGES.items():
+            subproject_stages = [i for i in subproject_stages if i in stages]
+            if not subproject_stages:
+                continue
+            # the JVM does not survive a fork, so every subproject starts a fresh interpreter
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                try:
+                    results += executor.submit(run_subproject, subproject, subproject_stages, config, Path(directory)).result()
+                except Exception as e:
+                    # e.g., the process of the subproject crashed with its JVM
+                    traceback.print_exc()
+                    results += [{"stage": i, "error": f"{type(e).__name__}: {e}"} for i in subproject_stages]
+
+    timestamp = datetime.now()
+    if output is None:
+        output = Path(__file__).parent / "results" / f"{timestamp.strftime('%Y-%m-%d-%H-%M-%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "timestamp": timestamp.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "stages": results,
+    }, indent=2))
+    print(f"Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    main()
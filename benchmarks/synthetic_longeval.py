@@ -0,0 +1,192 @@
+"""
+A synthetic stand-in for LongEval-Sci datasets of ir_datasets_longeval: snapshots with documents, queries, and
+qrels that have the same interface as the datasets returned by ir_datasets_longeval.load, so that the scripts of
+the subprojects can be benchmarked without the real collections.
+"""
+import random
+from collections import namedtuple
+from datetime import datetime
+
+# Syllables of the pseudo words of the vocabulary
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "ta", "si", "po", "de", "ga", "vi", "bo", "che", "tor", "lan", "mer"]
+VOCABULARY_SIZE = 20000
+AUTHORS = 5000
+
+
+class SyntheticDocument(namedtuple("SyntheticDocument", ["doc_id", "title", "abstract", "authors", "links"])):
+    def default_text(self):
+        return f"{self.title} {self.abstract}"
+
+
+class SyntheticQuery(namedtuple("SyntheticQuery", ["query_id", "text"])):
+    def default_text(self):
+        return self.text
+
+
+SyntheticQrel = namedtuple("SyntheticQrel", ["query_id", "doc_id", "relevance", "iteration"])
+
+
+class SyntheticDocsStore:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def get(self, doc_id, field=None):
+        document = self.documents[doc_id]
+        return getattr(document, field) if field else document
+
+    def get_many(self, doc_ids, field=None):
+        return {i: self.get(i, field) for i in doc_ids if i in self.documents}
+
+    def get_many_iter(self, doc_ids):
+        return iter(self.get_many(doc_ids).values())
+
+
+class SyntheticSnapshot:
+    def __init__(self, snapshot, timestamp, documents, queries, qrels, prior_datasets):
+        self.snapshot = snapshot
+        self.timestamp = timestamp
+        self.documents = documents
+        self.queries = queries
+        self.qrels = qrels
+        self.prior_datasets = prior_datasets
+
+    def docs_iter(self):
+        return iter(self.documents.values())
+
+    def docs_count(self):
+        return len(self.documents)
+
+    def docs_store(self):
+        return SyntheticDocsStore(self.documents)
+
+    def queries_iter(self):
+        return iter(self.queries)
+
+    def qrels_iter(self):
+        return iter(self.qrels or [])
+
+    def has_qrels(self):
+        return self.qrels is not None
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def get_timestamp(self):
+        return self.timestamp
+
+    def get_datasets(self):
+        return None
+
+    def get_prior_datasets(self):
+        return self.prior_datasets
+
+    def __repr__(self):
+        return f"SyntheticSnapshot({self.snapshot})"
+
+
+class SyntheticCollection:
+    """
+    The collection of all snapshots, like the dataset of a LongEval task with several snapshots.
+    """
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    def get_datasets(self):
+        return self.snapshots
+
+    def get_snapshot(self):
+        return None
+
+    def get_prior_datasets(self):
+        return []
+
+    def has_qrels(self):
+        return False
+
+
+def vocabulary(rng):
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    # the frequency of a word depends on its position, so the order must not be alphabetical
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def load(num_documents=10000, snapshots=3, doc_overlap=0.8, num_queries=500, query_repetition=0.5, seed=0):
+    """
+    Generate a collection of snapshots one month apart. Every snapshot has the given number of documents, of which
+    the doc_overlap share is taken from the prior snapshot, and the given number of queries, of which the
+    query_repetition share repeats the text of a query of a prior snapshot. All snapshots but the last one have
+    qrels, like the training and test snapshots of LongEval.
+    """
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    # zipfian word frequencies as in natural language
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(words) + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    authors = [f"{rng.choice(words).title()} {rng.choice(words).title()}" for _ in range(AUTHORS)]
+    next_doc_id = iter(range(10 ** 8, 10 ** 9))
+
+    def new_document():
+        return SyntheticDocument(
+            doc_id=str(next(next_doc_id)),
+            title=" ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 12))),
+            abstract=" ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(50, 250))),
+            authors=[{"name": rng.choice(authors)} for _ in range(rng.randint(1, 5))],
+            links=[],
+        )
+
+    def new_query_text(doc_ids):
+        # queries are parts of the title or an author of the document that they are generated from
+        document = documents[rng.choice(doc_ids)]
+        if rng.random() < 0.1:
+            text = rng.choice(document.authors)["name"].lower()
+        else:
+            title = document.title.split()
+            start = rng.randrange(len(title))
+            text = " ".join(title[start:start + rng.randint(1, 4)])
+        query_sources[text] = document.doc_id
+        return text
+
+    ret = []
+    documents = {}
+    previous_query_texts = []
+    query_sources = {}
+    for snapshot in range(snapshots):
+        timestamp = datetime(2024 + (10 + snapshot) // 12, (10 + snapshot) % 12 + 1, 1)
+
+        kept = rng.sample(sorted(documents), int(len(documents) * doc_overlap))
+        documents = {i: documents[i] for i in kept}
+        while len(documents) < num_documents:
+            document = new_document()
+            documents[document.doc_id] = document
+
+        doc_ids = sorted(documents)
+        query_texts = []
+        for _ in range(num_queries):
+            if previous_query_texts and rng.random() < query_repetition:
+                query_texts.append(rng.choice(previous_query_texts))
+            else:
+                query_texts.append(new_query_text(doc_ids))
+        snapshot_queries = [SyntheticQuery(f"{snapshot}-{i}", text) for i, text in enumerate(query_texts)]
+
+        qrels = None
+        if snapshot < snapshots - 1:
+            qrels = []
+            for query in snapshot_queries:
+                # the document that the query was generated from is relevant, if it is still in the snapshot
+                judged = {query_sources[query.text]} & documents.keys()
+                judged.update(rng.sample(doc_ids, min(len(doc_ids), rng.randint(0, 4))))
+                for doc_id in sorted(judged):
+                    relevance = rng.choice([1, 2]) if doc_id == query_sources[query.text] else rng.choice([0, 0, 1])
+                    qrels.append(SyntheticQrel(query.query_id, doc_id, relevance, timestamp.strftime("%Y-%m")))
+
+        ret.append(SyntheticSnapshot(timestamp.strftime("%Y-%m"), timestamp, documents, snapshot_queries, qrels, list(ret)))
+        previous_query_texts += query_texts
+
+    return SyntheticCollection(ret)
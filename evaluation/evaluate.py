@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from ir_datasets_longeval import load
+
+
+def read_run(run_file):
+    return pd.read_csv(
+        run_file, sep=r"\s+", header=None, names=["qid", "q0", "docno", "rank", "score", "tag"],
+        usecols=["qid", "docno", "score"], dtype={"qid": str, "docno": str, "score": float},
+    )
+
+
+def read_runs(run_directories):
+    """
+    The runs of all snapshots of all run directories as one frame of (run, snapshot, qid, docno, score), the run is
+    the path of the run directory as given. A run directory has one sub directory with a run.txt.gz per snapshot,
+    as written by the retrieval scripts.
+    """
+    # the run directories of the subprojects are all named output, so their names do not identify a run
+    run_names = [str(i) for i in run_directories]
+    duplicates = sorted(set(i for i in run_names if run_names.count(i) > 1))
+    if duplicates:
+        raise ValueError(f"The run directories {', '.join(duplicates)} are given more than once.")
+
+    runs = []
+    for run_directory, run_name in zip(run_directories, run_names):
+        for run_file in sorted(run_directory.glob("*/run.txt.gz")):
+            runs.append(read_run(run_file).assign(run=run_name, snapshot=run_file.parent.name))
+    return pd.concat(runs, ignore_index=True)[["run", "snapshot", "qid", "docno", "score"]]
+
+
+def read_qrels(dataset):
+    ir_dataset = load(dataset)
+    snapshots = [ir_dataset] if not ir_dataset.get_datasets() else ir_dataset.get_datasets()
+
+    qrels = []
+    for snapshot in snapshots:
+        if not snapshot.has_qrels():
+            continue
+        qrels.append(pd.DataFrame(
+            [(snapshot.get_snapshot(), i.query_id, i.doc_id, i.relevance) for i in snapshot.qrels_iter()],
+            columns=["snapshot", "qid", "docno", "relevance"],
+        ))
+    return pd.concat(qrels, ignore_index=True)
+
+
+def evaluate(runs, qrels, k=10):
+    """
+    Evaluate all queries of all runs and snapshots at once on flat arrays, with the conventions of trec_eval:
+    documents are ranked by descending score (ties by descending docno), only queries with qrels are evaluated,
+    and the gain of a document is its relevance. Returns one row per (run, snapshot, qid).
+    """
+    # the judged queries as codes, shared by the qrels and the runs
+    qrels = qrels.assign(query=qrels.groupby(["snapshot", "qid"], sort=False).ngroup())
+    queries = qrels[["snapshot", "qid", "query"]].drop_duplicates()
+
+    run = runs.merge(queries, on=["snapshot", "qid"])
+    run = run.merge(qrels[["query", "docno", "relevance"]], on=["query", "docno"], how="left")
+    run = run.sort_values(["run", "query", "score", "docno"], ascending=[True, True, False, False], kind="stable")
+
+    group = run.groupby(["run", "query"], sort=False).ngroup().to_numpy()
+    group_start = np.r_[0, np.flatnonzero(np.diff(group)) + 1]
+    position = np.arange(len(run)) - np.repeat(group_start, np.diff(np.r_[group_start, len(run)]))
+    query = run["query"].to_numpy()[group_start]
+    gain = run["relevance"].fillna(0).clip(lower=0).to_numpy()
+    relevant = gain > 0
+    discount = 1 / np.log2(position + 2)
+    groups = len(group_start)
+
+    # ideal rankings of the judged queries
+    ideal = qrels.assign(gain=qrels["relevance"].clip(lower=0)).sort_values(["query", "gain"], ascending=[True, False], kind="stable")
+    ideal_query = ideal["query"].to_numpy()
+    ideal_position = ideal.groupby("query", sort=False).cumcount().to_numpy()
+    ideal_gain = ideal["gain"].to_numpy() / np.log2(ideal_position + 2)
+    queries_count = len(queries)
+    idcg = np.bincount(ideal_query, weights=ideal_gain, minlength=queries_count)
+    idcg_k = np.bincount(ideal_query, weights=ideal_gain * (ideal_position < k), minlength=queries_count)
+    num_relevant = np.bincount(ideal_query, weights=ideal["gain"].to_numpy() > 0, minlength=queries_count)
+
+    dcg = np.bincount(group, weights=gain * discount, minlength=groups)
+    dcg_k = np.bincount(group, weights=gain * discount * (position < k), minlength=groups)
+    relevant_k = np.bincount(group, weights=relevant & (position < k), minlength=groups)
+
+    # precision at the rank of every relevant document, the number of relevant documents up to it per query
+    relevant_so_far = np.cumsum(relevant)
+    relevant_so_far -= np.repeat(relevant_so_far[group_start] - relevant[group_start], np.diff(np.r_[group_start, len(run)]))
+    precision_sum = np.bincount(group, weights=relevant * relevant_so_far / (position + 1), minlength=groups)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = pd.DataFrame({
+            "run": run["run"].to_numpy()[group_start],
+            "snapshot": run["snapshot"].to_numpy()[group_start],
+            "qid": run["qid"].to_numpy()[group_start],
+            "ndcg": np.nan_to_num(dcg / idcg[query]),
+            f"ndcg_cut_{k}": np.nan_to_num(dcg_k / idcg_k[query]),
+            f"P_{k}": relevant_k / k,
+            "map": np.nan_to_num(precision_sum / num_relevant[query]),
+        })
+    return ret
+
+
+def temporal_measures(means, reference=None):
+    """
+    The LongEval measures of temporal persistence per run: the relative nDCG drop (ndcg of the reference snapshot
+    minus ndcg of the snapshot, relative to the reference) and the result delta (the difference of the ndcg of the
+    snapshot to the reference). The reference is the earliest snapshot unless another one is given.
+    """
+    reference = reference or means["snapshot"].min()
+    reference_ndcg = means[means["snapshot"] == reference].set_index("run")["ndcg"]
+    ndcg = means["ndcg"].to_numpy()
+    reference_ndcg = means["run"].map(reference_ndcg).to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return means.assign(relative_ndcg_drop=(reference_ndcg - ndcg) / reference_ndcg, result_delta=ndcg - reference_ndcg)
+
+
+@click.command()
+@click.option("--dataset", type=str, required=True, help="The dataset id or a local directory with the qrels of the snapshots.")
+@click.option("--run", "run_directories", type=Path, multiple=True, required=True, help="A run directory with one sub directory per snapshot that contains a run.txt.gz. Can be given several times.")
+@click.option("-k", type=int, default=10, help="The cut-off of nDCG@k and P@k.")
+@click.option("--reference", type=str, default=None, help="The reference snapshot of the temporal measures, by default the earliest snapshot.")
+@click.option("--per-query", type=Path, default=None, help="Optionally write the measures of every query to this file.")
+@click.option("--output", type=Path, default=None, help="Optionally write the tidy table of (run, snapshot, measure, value) to this file.")
+def main(dataset, run_directories, k, reference, per_query, output):
+    per_query_measures = evaluate(read_runs(run_directories), read_qrels(dataset), k)
+    if per_query:
+        per_query_measures.to_csv(per_query, sep="\t", index=False)
+
+    means = per_query_measures.drop(columns=["qid"]).groupby(["run", "snapshot"], as_index=False).mean()
+    means = means.assign(queries=per_query_measures.groupby(["run", "snapshot"]).size().to_numpy())
+    means = temporal_measures(means, reference)
+
+    table = means.melt(id_vars=["run", "snapshot"], var_name="measure", value_name="value")
+    if output:
+        table.to_csv(output, sep="\t", index=False)
+
+    print(table.pivot_table(index=["run", "measure"], columns="snapshot", values="value", sort=False).to_string(float_format="{:.4f}".format))
+
+
+if __name__ == "__main__":
+    main()
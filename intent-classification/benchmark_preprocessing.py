@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import ast
+import json
+import random
+from pathlib import Path
+from time import perf_counter
+
+import click
+import pandas as pd
+
+from preprocessing_train import group_by_query, merge_all, remove_duplicate_authors
+
+
+# The row-wise implementations of the baseline as reference, copied unchanged from preprocessing_train.py
+# (group_by_query) and snorkel_labelling_train.py (remove_duplicate_authors), only renamed
+
+
+def group_by_query_rowwise(df_queries_rel_docs):
+    """
+    group by query so all the authors, titles and abstracts are grouped together per query
+    """
+    grouped_df = df_queries_rel_docs.groupby(["query_id", "query_text"]).agg({
+    "doc_text": lambda texts: " ".join(str(t) for t in texts if pd.notnull(t)),
+    "doc_id": lambda ids: list(ids),
+    "doc_authors": lambda authors: list(authors),
+    "doc_title": lambda titles: list(titles),
+    }).reset_index()
+    grouped_df["nb_clicks"] = grouped_df["doc_id"].apply(lambda x: len(x) if isinstance(x, list) else 0)
+    return grouped_df
+
+
+def remove_duplicate_authors_rowwise(df):
+    """
+    If the paper's name is already there and the names of the authors of the same paper are repeated twice
+    """
+    def process_row(row):
+        try:
+            titles = ast.literal_eval(row['doc_title'])
+            authors = ast.literal_eval(row['doc_authors'])
+        except Exception:
+            return row  # Skip malformed entries
+
+        seen = set()
+        filtered_titles = []
+        filtered_authors = []
+
+        for title, author_group in zip(titles, authors):
+            if title not in seen:
+                seen.add(title)
+                filtered_titles.append(title)
+                filtered_authors.append(author_group)
+
+        row['doc_title'] = str(filtered_titles)
+        row['doc_authors'] = str(filtered_authors)
+        return row
+    return df.apply(process_row, axis=1)
+
+
+def synthetic_docs(doc_ids, seed):
+    """
+    The split has no document contents, so every doc gets a synthetic abstract, title, and authors. Titles are
+    drawn from a small pool so that queries have duplicate titles as in the corpus.
+    """
+    rng = random.Random(seed)
+    titles = [f"title {i}" for i in range(max(1, len(doc_ids) // 4))]
+    return pd.DataFrame({
+        "doc_id": doc_ids,
+        "doc_text": [f"abstract of {i}" for i in doc_ids],
+        "doc_links": [[] for _ in doc_ids],
+        "doc_title": [rng.choice(titles) for _ in doc_ids],
+        "doc_authors": [[{"name": f"author {rng.randrange(1000)}"} for _ in range(rng.randint(1, 4))] for _ in doc_ids],
+    })
+
+
+def timed(function, *args):
+    start = perf_counter()
+    ret = function(*args)
+    return ret, perf_counter() - start
+
+
+@click.command()
+@click.option("--split", type=Path, default=Path("../train-test-split"), help="The directory with the train-test split.")
+@click.option("--repetitions", type=int, default=10, help="The number of copies of the queries and qrels.")
+@click.option("--seed", type=int, default=0, help="The seed of the synthetic documents.")
+@click.option("--output", type=Path, default=None, help="Optionally write the results as JSON to this file.")
+def main(split, repetitions, seed, output):
+    queries = pd.read_csv(split / "queries_train.csv.gz").rename(columns={"text": "query_text"})
+    qrels = pd.read_csv(split / "qrels_train.csv.gz", dtype={"doc_id": str})[["query_id", "doc_id", "relevance"]]
+    # copies of the queries with their qrels, as if the queries of several snapshots were labelled
+    queries = pd.concat([queries.assign(query_id=queries["query_id"] + f"-{i}") for i in range(repetitions)], ignore_index=True)
+    qrels = pd.concat([qrels.assign(query_id=qrels["query_id"] + f"-{i}") for i in range(repetitions)], ignore_index=True)
+    docs = synthetic_docs(sorted(qrels["doc_id"].unique()), seed)
+    df_merged = merge_all(queries, qrels, docs)
+
+    # the baseline de-duplicated the stringified lists of the TSV files
+    df_grouped = group_by_query_rowwise(df_merged)
+    df_grouped["doc_authors"] = df_grouped["doc_authors"].apply(json.dumps)
+    df_grouped["doc_title"] = df_grouped["doc_title"].apply(json.dumps)
+
+    results = []
+    for name, rowwise, columnar, df in [
+        ("group_by_query", group_by_query_rowwise, group_by_query, df_merged),
+        ("remove_duplicate_authors", remove_duplicate_authors_rowwise, remove_duplicate_authors, df_grouped),
+    ]:
+        expected, rowwise_seconds = timed(rowwise, df)
+        actual, columnar_seconds = timed(columnar, df)
+        result = {
+            "function": name,
+            "rows": len(df),
+            "rowwise_seconds": rowwise_seconds,
+            "columnar_seconds": columnar_seconds,
+            "identical_output": repr(expected.to_dict("records")) == repr(actual.to_dict("records")),
+        }
+        results.append(result)
+        print(f"{name}\t{rowwise_seconds:.3f}s row-wise\t{columnar_seconds:.3f}s columnar\tidentical output: {result['identical_output']}")
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import json
+from importlib.metadata import version
+from pathlib import Path
+from snorkel.labeling.model.label_model import LabelModel
+from longeval_common.spans import span
+
+MODEL_FILE = 'models/snorkel_intent_model'
+# Fixed seed so that fitting the label model is reproducible
+SEED = 123
+
+
+def fit_label_model(L_train):
+    label_model = LabelModel(cardinality=2, verbose=True)
+    with span('label model fit', len(L_train)):
+        label_model.fit(L_train=L_train, n_epochs=500, log_freq=100, seed=SEED)
+    return label_model
+
+
+def save_label_model(label_model, lfs, filename=MODEL_FILE):
+    """
+    Save the fitted label model and, as JSON next to it, the snorkel version and the names of the labelling
+    functions in the order of the columns of the label matrix
+    """
+    label_model.save(filename)
+    metadata = {
+        'snorkel_version': version('snorkel'),
+        'cardinality': label_model.cardinality,
+        'lfs': [lf.name for lf in lfs],
+    }
+    Path(filename + '.json').write_text(json.dumps(metadata, indent=2))
+
+
+def load_label_model(lfs, filename=MODEL_FILE):
+    """
+    Load a label model saved by save_label_model that was fitted for the labelling functions lfs.
+    Models without metadata are accepted if they were fitted for the same number of labelling functions.
+    """
+    label_model = LabelModel(cardinality=2)
+    label_model.load(filename)
+
+    lf_names = [lf.name for lf in lfs]
+    if Path(filename + '.json').exists():
+        metadata = json.loads(Path(filename + '.json').read_text())
+        if metadata['lfs'] != lf_names:
+            raise ValueError(f'The label model {filename} was fitted for the labelling functions {metadata["lfs"]}, not {lf_names}.')
+    elif label_model.m != len(lfs):
+        raise ValueError(f'The label model {filename} was fitted for {label_model.m} labelling functions, not {len(lfs)}.')
+
+    return label_model
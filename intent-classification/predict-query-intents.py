@@ -1,72 +1,271 @@
 #!/usr/bin/env python3
+from collections import OrderedDict
 from pathlib import Path
 import click
+import hashlib
 from ir_datasets_longeval import load
 import gzip
 import json
-from tirex_tracker import tracking, ExportFormat
+import numpy as np
+import pandas as pd
+from tirex_tracker import ExportFormat
+from intent_model import MODEL_FILE, load_label_model
+from preprocessing_train import remove_duplicate_authors
+from query_matching import QueryMatcher, normalise_query
+from snorkel_labelling_train import lfs
+from longeval_common.spans import span, tracked
+from vectorised_labelling import apply_lfs
 
-def predict_intent(query_text, relevant_docs):
-    return 1
+QRELS_DTYPE = [("query", np.int32), ("doc", np.int32), ("relevance", np.int8)]
+# The fields of a document that the labelling functions use
+DOCUMENT_FIELDS = ["title", "authors", "abstract"]
+DOCUMENT_CACHE_SIZE = 100000
+PREDICTION_BATCH_SIZE = 10000
 
-def add_query_to_relevant_docs(dataset, ret):
+# The label model is loaded lazily by get_label_model
+label_model = None
+
+
+def snapshot_id(dataset):
+    return dataset.get_snapshot() or dataset.get_timestamp().strftime("%Y-%m")
+
+
+def qrels_key(dataset):
+    """
+    The key of the qrels of a snapshot. Snapshots of different datasets share their name but not their qrels
+    (e.g., snapshot-1/train/raw and snapshot-1/train/dctr of longeval-sci-2026), so the key includes a hash of
+    the path and the modification time of the qrels file.
+    """
+    try:
+        qrels_file = Path(dataset.qrels_path()).resolve()
+    except AttributeError:
+        # datasets that do not read their qrels from a file are identified by their snapshot only
+        return snapshot_id(dataset)
+    identity = f"{qrels_file}\t{qrels_file.stat().st_mtime_ns}"
+    return f"{snapshot_id(dataset)}-{hashlib.sha256(identity.encode()).hexdigest()[:16]}"
+
+
+def build_qrels_lookup(dataset, directory):
+    """
+    Save the relevance judgments of a snapshot in a compact format: the sorted normalised query texts and
+    doc_ids as vocabularies and the qrels as one array of (query, doc, relevance) codes sorted by query.
+    """
     print(dataset)
-    if not dataset.has_qrels():
+    query_id_to_text = {i.query_id: normalise_query(i.default_text()) for i in dataset.queries_iter()}
+
+    qrels = {}
+    for qrel in dataset.qrels_iter():
+        if qrel.query_id in query_id_to_text:
+            qrels[(query_id_to_text[qrel.query_id], qrel.doc_id)] = qrel.relevance
+
+    query_texts = sorted(set(i[0] for i in qrels))
+    doc_ids = sorted(set(i[1] for i in qrels))
+    query_codes = {query_text: code for code, query_text in enumerate(query_texts)}
+    doc_codes = {doc_id: code for code, doc_id in enumerate(doc_ids)}
+
+    array = np.array(
+        sorted((query_codes[query_text], doc_codes[doc_id], relevance) for (query_text, doc_id), relevance in qrels.items()),
+        dtype=QRELS_DTYPE,
+    )
+
+    tmp_directory = directory.with_name(f"{directory.name}.tmp")
+    tmp_directory.mkdir(parents=True, exist_ok=True)
+    (tmp_directory / "queries.json").write_text(json.dumps(query_texts))
+    (tmp_directory / "doc_ids.json").write_text(json.dumps(doc_ids))
+    np.save(tmp_directory / "qrels.npy", array)
+    tmp_directory.rename(directory)
+
+
+class DocumentCache:
+    """
+    Bounded LRU cache of the documents of one snapshot that keeps only the DOCUMENT_FIELDS of a document.
+    Missing documents are read in bulk with docs_store.get_many in sorted doc_id order.
+    """
+    def __init__(self, dataset, size=DOCUMENT_CACHE_SIZE):
+        self.dataset = dataset
+        self.size = size
+        self.docs_store = None
+        self.documents = OrderedDict()
+
+    def get_many(self, doc_ids):
+        missing = sorted(set(doc_ids) - self.documents.keys())
+        if missing:
+            if self.docs_store is None:
+                self.docs_store = self.dataset.docs_store()
+            with span("doc-store reads", len(missing)):
+                for doc_id, doc in self.docs_store.get_many(missing).items():
+                    self.documents[doc_id] = {i: getattr(doc, i, None) for i in DOCUMENT_FIELDS}
+
+        ret = {}
+        for doc_id in doc_ids:
+            if doc_id in self.documents:
+                self.documents.move_to_end(doc_id)
+                ret[doc_id] = self.documents[doc_id]
+
+        while len(self.documents) > self.size:
+            self.documents.popitem(last=False)
+
         return ret
 
-    docs_store = dataset.docs_store()
-    query_id_to_relevant_documents = {}
 
-    for qrel in dataset.qrels_iter():
-        if qrel.query_id not in query_id_to_relevant_documents:
-            query_id_to_relevant_documents[qrel.query_id] = {}
-        query_id_to_relevant_documents[qrel.query_id][qrel.doc_id] = qrel.relevance
-
-    for query in dataset.queries_iter():
-        query_text = query.default_text().lower().strip()
-        if query_text not in ret:
-            ret[query_text] = {}
-        for doc in query_id_to_relevant_documents.get(query.query_id, []):
-            ret[query_text][doc] = docs_store.get(doc)
-    return ret
+class HistoricalQrels:
+    """
+    Lookup of normalised query text -> (snapshot, doc_id, relevance) over several snapshots, which are identified
+    by the qrels_key of their qrels. The lookup of each snapshot is built once, saved to the cache directory, and
+    memory-mapped on later runs.
+    """
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.snapshots = {}
 
-def query_to_relevant_documents_from_prior_datasets(datasets):
-    ret = {}
+    def add(self, dataset):
+        if not dataset.has_qrels():
+            return
+        snapshot = qrels_key(dataset)
+        if snapshot in self.snapshots:
+            return
+
+        directory = self.cache_directory / snapshot
+        if not (directory / "qrels.npy").exists():
+            with span("qrels loading"):
+                build_qrels_lookup(dataset, directory)
+
+        query_texts = json.loads((directory / "queries.json").read_text())
+        qrels = np.load(directory / "qrels.npy", mmap_mode="r")
+        self.snapshots[snapshot] = {
+            "documents": DocumentCache(dataset),
+            "query_codes": {query_text: code for code, query_text in enumerate(query_texts)},
+            "doc_ids": json.loads((directory / "doc_ids.json").read_text()),
+            "qrels": qrels,
+            "offsets": np.searchsorted(qrels["query"], np.arange(len(query_texts) + 1)),
+        }
+
+    def query_texts(self):
+        return set().union(*[i["query_codes"].keys() for i in self.snapshots.values()])
+
+    def qrels(self, query_text):
+        ret = []
+        for snapshot, lookup in self.snapshots.items():
+            if query_text not in lookup["query_codes"]:
+                continue
+            code = lookup["query_codes"][query_text]
+            for qrel in lookup["qrels"][lookup["offsets"][code]:lookup["offsets"][code + 1]]:
+                ret.append((snapshot, lookup["doc_ids"][qrel["doc"]], int(qrel["relevance"])))
+        return ret
+
+    def documents_of_queries(self, query_texts):
+        """
+        The relevant documents of many queries as query text -> doc_id -> document fields. Every document is
+        read only once per snapshot, in bulk, and shared by all queries that refer to it.
+        """
+        doc_ids_per_snapshot = {}
+        query_to_doc_ids = {}
+        for query_text in query_texts:
+            query_to_doc_ids[query_text] = {doc_id: snapshot for snapshot, doc_id, relevance in self.qrels(query_text) if relevance != 0}
+            for doc_id, snapshot in query_to_doc_ids[query_text].items():
+                doc_ids_per_snapshot.setdefault(snapshot, set()).add(doc_id)
+
+        documents = {
+            snapshot: self.snapshots[snapshot]["documents"].get_many(doc_ids)
+            for snapshot, doc_ids in doc_ids_per_snapshot.items()
+        }
+
+        return {
+            query_text: {doc_id: documents[snapshot].get(doc_id) for doc_id, snapshot in doc_ids.items()}
+            for query_text, doc_ids in query_to_doc_ids.items()
+        }
+
+
+def load_historical_qrels(datasets, cache_directory):
+    historical_qrels = HistoricalQrels(cache_directory)
 
     for dataset in datasets:
-        ret = add_query_to_relevant_docs(dataset, ret)
+        historical_qrels.add(dataset)
         for p in dataset.get_prior_datasets():
-            ret = add_query_to_relevant_docs(p, ret)
+            historical_qrels.add(p)
 
+    return historical_qrels
+
+
+def get_label_model(model_file):
+    """
+    The label model is loaded only once, when the first intents are predicted.
+    """
+    global label_model
+    if label_model is None:
+        label_model = load_label_model(lfs, str(model_file))
+    return label_model
+
+
+def labelling_frame(query_texts, query_to_documents):
+    """
+    The queries with the titles and authors of their relevant documents in the format of the training data of the label model.
+    """
+    rows = []
+    for query_text in query_texts:
+        documents = query_to_documents[query_text].values()
+        rows.append({
+            "query_text": query_text,
+            "doc_title": [i["title"] if i else None for i in documents],
+            "doc_authors": [i["authors"] if i else None for i in documents],
+            "nb_clicks": len(documents),
+        })
+    return remove_duplicate_authors(pd.DataFrame(rows, columns=["query_text", "doc_title", "doc_authors", "nb_clicks"]))
+
+
+def predict_intents(query_texts, historical_qrels, model_file):
+    """
+    Predict the intents of the queries with the label model, one predict_proba call per batch of queries.
+    """
+    ret = {}
+    for i in range(0, len(query_texts), PREDICTION_BATCH_SIZE):
+        batch = query_texts[i:i + PREDICTION_BATCH_SIZE]
+        df = labelling_frame(batch, historical_qrels.documents_of_queries(batch))
+        L = apply_lfs(df, lfs)
+        with span("label model prediction", len(batch)):
+            probs = get_label_model(model_file).predict_proba(L=L)[:, 1]
+        for query_text, prob in zip(batch, probs):
+            ret[query_text] = {"intent": "navigational" if prob > 0.5 else "exploratory", "prob_navigational": float(prob)}
     return ret
 
-def process_dataset(ir_dataset, output_directory, query_to_relevant_documents):
+
+def process_dataset(ir_dataset, output_directory, historical_qrels, model_file, matcher=None):
     if (output_directory / "queries.jsonl.gz").exists():
         return
 
-    with tracking(export_file_path=output_directory / "intent-prediction-metadata.yml", export_format=ExportFormat.IR_METADATA):
-        query_intents = {}
-        for query_text in query_to_relevant_documents.keys():
-            if len(query_to_relevant_documents[query_text]) == 0:
-                continue
-            query_intents[query_text] = predict_intent(query_text, query_to_relevant_documents[query_text])
+    with tracked(output_directory / "intent-prediction-metadata.yml", "intent prediction", export_format=ExportFormat.IR_METADATA):
+        query_texts = sorted({normalise_query(i.default_text()) for i in ir_dataset.queries_iter()})
+        if matcher:
+            # queries without an exact match in the historical queries use the previously relevant documents of a near duplicate
+            historical_query_texts = dict(zip(query_texts, matcher.match(query_texts)[0]))
+        else:
+            historical_query_texts = {i: i for i in query_texts}
+
+        # only queries with previously relevant documents get an intent
+        predict = sorted({i for i in historical_query_texts.values() if i and any(relevance != 0 for _, _, relevance in historical_qrels.qrels(i))})
+        historical_intents = predict_intents(predict, historical_qrels, model_file) if predict else {}
+        query_intents = {i: historical_intents[j] for i, j in historical_query_texts.items() if j in historical_intents}
 
     with gzip.open(output_directory / "queries.jsonl.gz", "wt") as f:
         for query in ir_dataset.queries_iter():
-            query_text = query.default_text().lower().strip()
-            f.write(json.dumps({"qid": query.query_id, "intent": query_intents.get(query_text, None)}) + "\n")
+            prediction = query_intents.get(normalise_query(query.default_text()), {"intent": None, "prob_navigational": None})
+            f.write(json.dumps({"qid": query.query_id, **prediction}) + "\n")
 
 @click.command()
 @click.option("--predict", type=str, help="The dataset id or a local directory on which the predictions should be made.")
 @click.option("--prior-datasets", type=str, multiple=True, help="The dataset id or a local directory on which the predictions should be made.")
 @click.option("--output", type=Path, required=True, help="The output directory.")
-def main(predict, prior_datasets, output):
+@click.option("--qrels-cache", type=Path, default=Path("data/qrels-lookup"), help="The directory in which the qrels lookup of each snapshot is cached.")
+@click.option("--model", type=Path, default=Path(MODEL_FILE), help="The label model saved by snorkel_labelling_train.py.")
+@click.option("--query-similarity", type=click.FloatRange(0, 1), default=None, help="Queries without an exact match in the previous queries use the most similar previous query with at least this similarity of their character n-grams. Only exact matches are used by default.")
+def main(predict, prior_datasets, output, qrels_cache, model, query_similarity):
     ir_dataset = load(predict)
     datasets = [ir_dataset] if not ir_dataset.get_datasets() else ir_dataset.get_datasets()
-    query_to_relevant_documents = query_to_relevant_documents_from_prior_datasets(datasets + [load(i) for i in prior_datasets])
+    historical_qrels = load_historical_qrels(datasets + [load(i) for i in prior_datasets], qrels_cache)
+    matcher = QueryMatcher(sorted(historical_qrels.query_texts()), threshold=query_similarity) if query_similarity is not None else None
 
     for d in datasets:
-        process_dataset(d, output / d.get_snapshot(), query_to_relevant_documents)
+        process_dataset(d, output / d.get_snapshot(), historical_qrels, model, matcher)
 
 if __name__ == "__main__":
     main()
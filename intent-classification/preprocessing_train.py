@@ -1,7 +1,11 @@
 from ir_datasets_longeval import load
+import numpy as np
 import pandas as pd
 import ast
 import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from longeval_common.corpus_cache import get_corpus
 
 
 def read_tsv(filename):
@@ -13,6 +17,41 @@ def write_tsv(df,filename):
     df.to_csv(filename, sep='\t',index=False)
 
 
+def read_parquet(filename):
+    """
+    Read a parquet file with nested columns (e.g., doc_authors, doc_title) as native python lists
+    """
+    table = pq.read_table(filename)
+    df = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type) or pa.types.is_struct(field.type):
+            df[field.name] = table.column(field.name).to_pylist()
+    return df
+
+
+def write_parquet(df, filename):
+    df.to_parquet(filename, index=False)
+
+
+def nested_list(value):
+    """
+    The value of a nested column as list, values from TSV files are strings of lists that are parsed
+    """
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    return value
+
+
+def nested_text(value):
+    """
+    The text of a nested column as the labelling functions match it, i.e., the string of the list as in the TSV
+    files, e.g., "['Title A', 'Title B']" for all titles of a query
+    """
+    if isinstance(value, list):
+        return str(value)
+    return value
+
+
 def get_queries(ds_longeval):
     queries = [(q.query_id, q.text) for q in ds_longeval.queries_iter()]
     df_queries = pd.DataFrame(queries, columns=["query_id", "query_text"])
@@ -26,7 +65,13 @@ def get_qrels(ds_longeval):
     return df_qrels
 
 
-def get_docs(ds_longeval):
+def get_docs(ds_longeval, corpus_cache=None):
+    """
+    All documents of the dataset, read with only the needed columns from the columnar corpus cache if there is one
+    """
+    if corpus_cache:
+        df_docs = get_corpus(ds_longeval, corpus_cache).to_pandas(["doc_id", "abstract", "links", "title", "authors"])
+        return df_docs.rename(columns={"abstract": "doc_text", "links": "doc_links", "title": "doc_title", "authors": "doc_authors"})
     # Iterate through documents
     docs = [(doc.doc_id, doc.abstract, doc.links, doc.title, doc.authors) for doc in  ds_longeval.docs_iter()]
     # Convert to DataFrame
@@ -48,20 +93,93 @@ def group_by_query(df_queries_rel_docs):
     """
     group by query so all the authors, titles and abstracts are grouped together per query
     """
-    grouped_df = df_queries_rel_docs.groupby(["query_id", "query_text"]).agg({
-    "doc_text": lambda texts: " ".join(str(t) for t in texts if pd.notnull(t)),
-    "doc_id": lambda ids: list(ids),
-    "doc_authors": lambda authors: list(authors),
-    "doc_title": lambda titles: list(titles),
-    }).reset_index()
-    grouped_df["nb_clicks"] = grouped_df["doc_id"].apply(lambda x: len(x) if isinstance(x, list) else 0)
+    keys = ["query_id", "query_text"]
+    # one stable sort by query instead of one python aggregation per query and column: the rows of each
+    # query are consecutive and keep their order, so the lists per query are slices of the sorted columns
+    df = df_queries_rel_docs.dropna(subset=keys).sort_values(keys, kind="stable")
+    grouped = df.groupby(keys, sort=True)
+    sizes = grouped.size()
+    grouped_df = sizes.index.to_frame(index=False)
+    if len(grouped_df) == 0:
+        return grouped_df.assign(doc_text=[], doc_id=[], doc_authors=[], doc_title=[], nb_clicks=[])
+    boundaries = np.cumsum(sizes.to_numpy())[:-1]
+
+    texts = df.loc[df["doc_text"].notnull(), "doc_text"].astype(str).to_numpy()
+    text_boundaries = np.cumsum(grouped["doc_text"].count().to_numpy())[:-1]
+    grouped_df["doc_text"] = [" ".join(i) for i in np.split(texts, text_boundaries)]
+
+    for column in ["doc_id", "doc_authors", "doc_title"]:
+        grouped_df[column] = [i.tolist() for i in np.split(df[column].to_numpy(), boundaries)]
+
+    grouped_df["nb_clicks"] = sizes.to_numpy()
     return grouped_df
 
 
+def stream_group_by_query(ds_longeval, batch_size=10000, corpus_cache=None):
+    """
+    Streaming version of group_by_query(merge_all(get_queries(ds), get_qrels(ds), get_docs(ds))). Only the documents
+    of qrels with relevance != 0 are read, in batches via the doc store (or the columnar corpus cache if there is one),
+    and are grouped per query while reading.
+    """
+    query_texts = {q.query_id: q.text for q in ds_longeval.queries_iter()}
+    docs_store = get_corpus(ds_longeval, corpus_cache) if corpus_cache else ds_longeval.docs_store()
+    judged_queries = set()
+    groups = {}
+
+    def add_batch(batch):
+        docs = docs_store.get_many(sorted({doc_id for _, doc_id in batch}))
+        for query_id, doc_id in batch:
+            doc = docs.get(doc_id)
+            group = groups.setdefault(query_id, {"doc_text": [], "doc_id": [], "doc_authors": [], "doc_title": []})
+            group["doc_text"].append(doc.abstract if doc else None)
+            group["doc_id"].append(doc_id)
+            group["doc_authors"].append(doc.authors if doc else None)
+            group["doc_title"].append(doc.title if doc else None)
+
+    batch = []
+    for qrel in ds_longeval.qrels_iter():
+        if qrel.query_id not in query_texts:
+            continue
+        judged_queries.add(qrel.query_id)
+        if qrel.relevance == 0:
+            continue
+        batch.append((qrel.query_id, qrel.doc_id))
+        if len(batch) >= batch_size:
+            add_batch(batch)
+            batch = []
+    if batch:
+        add_batch(batch)
+
+    rows = []
+    for query_id, query_text in query_texts.items():
+        if query_id in groups:
+            group = groups[query_id]
+        elif query_id in judged_queries:
+            # all documents of the query are irrelevant
+            continue
+        else:
+            # like the left join of merge_all, queries without qrels keep a single row without a document
+            group = {"doc_text": [None], "doc_id": [None], "doc_authors": [None], "doc_title": [None]}
+        rows.append({
+            "query_id": query_id,
+            "query_text": query_text,
+            "doc_text": " ".join(str(t) for t in group["doc_text"] if pd.notnull(t)),
+            "doc_id": group["doc_id"],
+            "doc_authors": group["doc_authors"],
+            "doc_title": group["doc_title"],
+        })
+
+    grouped_df = pd.DataFrame(rows, columns=["query_id", "query_text", "doc_text", "doc_id", "doc_authors", "doc_title"])
+    grouped_df = grouped_df.sort_values(["query_id", "query_text"]).reset_index(drop=True)
+    return nb_of_clicks(grouped_df)
+
+
 def nb_of_clicks(grouped_df):
     """
-    add number of clicks
+    add number of clicks, unless group_by_query already counted them
     """
+    if "nb_clicks" in grouped_df.columns:
+        return grouped_df
     grouped_df["nb_clicks"] = grouped_df["doc_id"].apply(lambda x: len(x) if isinstance(x, list) else 0)
     return grouped_df
 
@@ -70,28 +188,45 @@ def list_to_string(df):
     df['doc_title'] = df['doc_title'].apply(json.dumps)
     return df
 
+def parse_nested(value):
+    try:
+        return nested_list(value)
+    except Exception:
+        return None  # malformed entries are skipped
+
+
 def remove_duplicate_authors(df):
     """
-    If the paper's name is already there and the names of the authors of the same paper are repeated twice
-    """
-    def process_row(row):
-        try:
-            titles = ast.literal_eval(row['doc_title'])
-            authors = ast.literal_eval(row['doc_authors'])
-        except Exception:
-            return row  # Skip malformed entries
-
-        seen = set()
-        filtered_titles = []
-        filtered_authors = []
-
-        for title, author_group in zip(titles, authors):
-            if title not in seen:
-                seen.add(title)
-                filtered_titles.append(title)
-                filtered_authors.append(author_group)
-
-        row['doc_title'] = str(filtered_titles)
-        row['doc_authors'] = str(filtered_authors)
-        return row
-    return df.apply(process_row, axis=1)
\ No newline at end of file
+    If the paper's name is already there and the names of the authors of the same paper are repeated twice.
+    The (query, title) pairs of all queries are de-duplicated at once on the exploded titles and authors.
+    """
+    titles = df['doc_title'].map(parse_nested)
+    authors = df['doc_authors'].map(parse_nested)
+    valid = (titles.map(lambda x: isinstance(x, list)) & authors.map(lambda x: isinstance(x, list))).to_numpy()
+    rows = np.flatnonzero(valid)
+
+    # pairs of title and author group per query, as zip(titles, authors) of each query
+    lengths = np.array([min(len(t), len(a)) for t, a in zip(titles[valid], authors[valid])], dtype=np.int64)
+    pairs = pd.DataFrame({
+        'row': np.repeat(rows, lengths),
+        'doc_title': [t for ts, n in zip(titles[valid], lengths) for t in ts[:n]],
+        'doc_authors': [a for as_, n in zip(authors[valid], lengths) for a in as_[:n]],
+    })
+    pairs = pairs.drop_duplicates(['row', 'doc_title'])
+    # the remaining pairs are still ordered by row, so the lists per row are slices of them
+    boundaries = np.cumsum(np.bincount(np.searchsorted(rows, pairs['row'].to_numpy()), minlength=len(rows)))[:-1]
+
+    df = df.copy()
+    for column in ['doc_title', 'doc_authors']:
+        values = df[column].to_numpy(copy=True)
+        for row, value in zip(rows, np.split(pairs[column].to_numpy(), boundaries)):
+            # keep the type of the input: native lists stay lists, strings from TSV files stay strings
+            values[row] = value.tolist() if isinstance(values[row], list) else str(value.tolist())
+        df[column] = values
+    return df
+
+
+if __name__ == '__main__':
+    dataset = load("longeval-sci/2024-11/train")
+    df_grouped_by_query = remove_duplicate_authors(stream_group_by_query(dataset))
+    write_parquet(df_grouped_by_query, "data/output/docs_grouped_by_queries.parquet")
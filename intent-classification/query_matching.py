@@ -0,0 +1,89 @@
+import zlib
+import numpy as np
+import pandas as pd
+
+MERSENNE_PRIME = (1 << 31) - 1
+SIGNATURE_BATCH_SIZE = 10000
+
+
+def normalise_query(query_text):
+    return query_text.lower().strip()
+
+
+def ngram_hashes(text, ngram_size):
+    # padded, so that word boundaries and queries shorter than the n-grams have n-grams as well
+    text = f" {text} "
+    return {zlib.crc32(text[i:i + ngram_size].encode()) % MERSENNE_PRIME for i in range(max(1, len(text) - ngram_size + 1))}
+
+
+class QueryMatcher:
+    """
+    Matches query texts against the query texts of a query log. Exact matches are found by a hash lookup of the
+    normalised text, near matches by MinHash signatures of character n-grams with locality sensitive hashing:
+    only queries that share a band of their signatures are compared, instead of all pairs of queries.
+    """
+    def __init__(self, query_texts, threshold=0.8, ngram_size=3, num_perm=64, bands=16, seed=0):
+        if num_perm % bands != 0:
+            raise ValueError(f"The number of permutations {num_perm} is not divisible by the number of bands {bands}.")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.ngram_size = ngram_size
+        self.bands = bands
+
+        self.query_texts = list(dict.fromkeys(normalise_query(i) for i in query_texts if isinstance(i, str)))
+        self.exact = set(self.query_texts)
+        self.signatures = self.signatures_of(self.query_texts)
+        self.buckets = self.band_keys(self.signatures)
+
+    def signatures_of(self, query_texts):
+        signatures = [np.empty((0, len(self.a)), dtype=np.uint64)]
+        for start in range(0, len(query_texts), SIGNATURE_BATCH_SIZE):
+            hashes = [ngram_hashes(i, self.ngram_size) for i in query_texts[start:start + SIGNATURE_BATCH_SIZE]]
+            offsets = np.cumsum([0] + [len(i) for i in hashes[:-1]])
+            values = np.fromiter((h for i in hashes for h in i), dtype=np.uint64)
+            permuted = (values[:, None] * self.a[None, :] + self.b[None, :]) % MERSENNE_PRIME
+            signatures.append(np.minimum.reduceat(permuted, offsets, axis=0))
+        return np.concatenate(signatures)
+
+    def band_keys(self, signatures):
+        """
+        One row (band, key, query) per band of each signature, the key combines the rows of the band
+        """
+        # the rows per band are explicit, as they can not be inferred for a log without queries
+        bands = signatures.reshape(len(signatures), self.bands, signatures.shape[1] // self.bands)
+        keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+        for row in range(bands.shape[2]):
+            # overflows wrap around, which is fine for a hash
+            keys = keys * np.uint64(1000003) + bands[:, :, row]
+        return pd.DataFrame({
+            "band": np.tile(np.arange(self.bands), len(signatures)),
+            "key": keys.ravel(),
+            "query": np.repeat(np.arange(len(signatures)), self.bands),
+        })
+
+    def match(self, query_texts):
+        """
+        The most similar normalised query text of the log for each query text (None if no query of the log reaches
+        the threshold) and the estimated Jaccard similarity of their character n-grams.
+        """
+        texts = [normalise_query(i) if isinstance(i, str) else None for i in query_texts]
+        matches = [i if i in self.exact else None for i in texts]
+        similarities = np.array([1.0 if i is not None else 0.0 for i in matches])
+
+        near = [i for i, text in enumerate(texts) if text is not None and matches[i] is None]
+        if not near or not self.query_texts:
+            return matches, similarities
+
+        signatures = self.signatures_of([texts[i] for i in near])
+        candidates = self.band_keys(signatures).merge(self.buckets, on=["band", "key"], suffixes=("", "_log"))
+        candidates = candidates[["query", "query_log"]].drop_duplicates()
+        candidates["similarity"] = (signatures[candidates["query"]] == self.signatures[candidates["query_log"]]).mean(axis=1)
+        candidates = candidates[candidates["similarity"] >= self.threshold]
+        best = candidates.sort_values(["query", "similarity", "query_log"], ascending=[True, False, True]).drop_duplicates("query")
+
+        for query, query_log, similarity in best.itertuples(index=False):
+            matches[near[query]] = self.query_texts[query_log]
+            similarities[near[query]] = similarity
+        return matches, similarities
@@ -1,8 +1,10 @@
 import pandas as pd
-from snorkel.labeling import labeling_function, PandasLFApplier
-from snorkel.labeling.model.label_model import LabelModel
-import ast
-from preprocessing_train import write_tsv, get_queries, get_qrels, get_docs, merge_all, group_by_query, nb_of_clicks,list_to_string,remove_duplicate_authors
+from snorkel.labeling import labeling_function
+from pathlib import Path
+from vectorised_labelling import apply_lfs
+from intent_model import MODEL_FILE, fit_label_model, load_label_model
+from query_matching import QueryMatcher, normalise_query
+from preprocessing_train import write_parquet, get_queries, stream_group_by_query, nb_of_clicks,remove_duplicate_authors, nested_list, nested_text
 from ir_datasets_longeval import load
 
 
@@ -19,13 +21,15 @@ def snorkel_to_intent_category(df):
 def snorkel_apply(df,lfs):
     """
     Applying Snorkel to the queries for which we have information about previously relevant documents
-    (queries that match on query_id with train)
+    (queries that match on query_id with train). Uses the label model saved by snorkel_labelling_train.py
+    if there is one, otherwise a label model is fitted on the queries.
     """
 
-    applier = PandasLFApplier(lfs=lfs)
-    L_train = applier.apply(df=df)
-    label_model = LabelModel(cardinality=2, verbose=True)
-    label_model.fit(L_train=L_train, n_epochs=500, log_freq=100)
+    L_train = apply_lfs(df, lfs)
+    if Path(MODEL_FILE).exists():
+        label_model = load_label_model(lfs)
+    else:
+        label_model = fit_label_model(L_train)
     preds = label_model.predict(L=L_train)
     df['snorkel_intent'] = preds
     probs = label_model.predict_proba(L=L_train)
@@ -43,10 +47,11 @@ def add_columns(df):
         df[col] = None
     return df
 
-def update_columns_from_train(df_target, df_source, columns_to_update, key='query_id'):
+def update_columns_from_train(df_target, df_source, columns_to_update, key='query_id', threshold=None):
     """
     Update the test df with information about previously relevant documents for the queries
-    that match on query_id with train
+    that match on query_id with train. With a threshold, the remaining queries are matched on their text
+    with the most similar train query (exact normalised text or near duplicates, see QueryMatcher)
     """
     # Select only relevant columns + key
     df_source_subset = df_source[[key] + columns_to_update]
@@ -61,6 +66,19 @@ def update_columns_from_train(df_target, df_source, columns_to_update, key='quer
             df_merged[col] = df_merged[new_col].combine_first(df_merged[col])
             df_merged.drop(columns=[new_col], inplace=True)
 
+    if threshold is not None:
+        matcher = QueryMatcher(df_source['query_text'], threshold=threshold)
+        matches, _ = matcher.match(df_merged['query_text'])
+        df_source_texts = df_source[df_source['query_text'].notnull()]
+        df_source_texts = df_source_texts.assign(matched_query_text=df_source_texts['query_text'].map(normalise_query))
+        df_source_texts = df_source_texts.drop_duplicates('matched_query_text')[['matched_query_text'] + columns_to_update]
+        df_merged = df_merged.assign(matched_query_text=matches).merge(df_source_texts, on='matched_query_text', how='left', suffixes=('', '_new'))
+        for col in columns_to_update:
+            # information matched on the key takes precedence
+            df_merged[col] = df_merged[col].combine_first(df_merged[f"{col}_new"])
+            df_merged.drop(columns=[f"{col}_new"], inplace=True)
+        df_merged.drop(columns=['matched_query_text'], inplace=True)
+
     return df_merged
 
 def merge_final_results(df,df_intent):
@@ -90,7 +108,7 @@ EXPLORATORY = -1
 @labeling_function()
 def lf_query_in_title_if_long(x):
     query = x.query_text.lower()
-    title = x.doc_title.lower()
+    title = nested_text(x.doc_title).lower()
     if len(query.split()) > 2 and query in title:
         return NAVIGATIONAL
     return EXPLORATORY
@@ -104,7 +122,7 @@ def lf_query_in_authors(x):
     """
     query = x.query_text.lower().strip()
     try:
-        author_groups = ast.literal_eval(x.doc_authors)
+        author_groups = nested_list(x.doc_authors)
     except (ValueError, SyntaxError, TypeError):
         return EXPLORATORY
     if not isinstance(author_groups, list):
@@ -116,7 +134,7 @@ def lf_query_in_authors(x):
         for author in group:
             if not isinstance(author, dict):
                 continue
-            author_name = author.get('name', '').lower()
+            author_name = (author.get('name') or '').lower()
             if query == author_name or query in author_name:
                 matched_groups += 1
                 break  # Only count once per group
@@ -136,16 +154,10 @@ def lf_low_clicks_navigational(x):
 if __name__ == '__main__':
     #train data
     dataset = load("longeval-sci/2024-11/train")
-    le_queries = get_queries(dataset)
-    le_qrels = get_qrels(dataset)
-    le_docs = get_docs(dataset)
-
-    #Preprocessing
-    df_merged = merge_all(le_queries, le_qrels, le_docs)
-    # preprocessing for Snorkel
-    df_grouped_by_query = group_by_query(df_merged)
-    df_queries_auth_title_string = list_to_string(df_grouped_by_query)
-    df_unique_authors_same_paper = remove_duplicate_authors(df_queries_auth_title_string)
+
+    #Preprocessing: only the relevant documents are read from the doc store and grouped by query
+    df_grouped_by_query = stream_group_by_query(dataset)
+    df_unique_authors_same_paper = remove_duplicate_authors(df_grouped_by_query)
     data_train = nb_of_clicks(df_unique_authors_same_paper)
     print("Preprocessing done")
 
@@ -166,8 +178,8 @@ if __name__ == '__main__':
     df_final_intent = snorkel_to_intent_category(df_snorkel_pred)
     data_test_final = merge_final_results(data_test_exp, df_final_intent)
 
-    output_directory = "data/output/longeval25_sci_test_2025_01_intent.tsv"
-    write_tsv(data_test_final, output_directory)
+    output_directory = "data/output/longeval25_sci_test_2025_01_intent.parquet"
+    write_parquet(data_test_final, output_directory)
 
     percentage_navigational = (data_test_final['snorkel_intent'] == "navigational").mean() * 100
     print(f"Percentage of navigational queries: {percentage_navigational:.2f}%")
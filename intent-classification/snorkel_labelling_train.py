@@ -1,8 +1,10 @@
 import pandas as pd
-from snorkel.labeling import labeling_function, PandasLFApplier
-from snorkel.labeling.model.label_model import LabelModel
-import ast
-from preprocessing_train import read_tsv, write_tsv
+from snorkel.labeling import labeling_function
+from pathlib import Path
+from vectorised_labelling import apply_lfs, check_parity, parity_fixture
+from intent_model import fit_label_model, save_label_model
+from longeval_common.spans import finished, write_trace
+from preprocessing_train import read_tsv, read_parquet, write_parquet, remove_duplicate_authors, nested_list, nested_text
 
 
 def list_to_string(df):
@@ -11,31 +13,13 @@ def list_to_string(df):
     return df
 
 
-def remove_duplicate_authors(df):
+def read_docs_grouped_by_queries(filename='data/output/docs_grouped_by_queries'):
     """
-    If the paper's name is already there and the names of the authors of the same paper are repeated twice
+    Read the documents grouped by queries from parquet with native list columns, or from TSV if there is no parquet file
     """
-    def process_row(row):
-        try:
-            titles = ast.literal_eval(row['doc_title'])
-            authors = ast.literal_eval(row['doc_authors'])
-        except Exception:
-            return row  # Skip malformed entries
-
-        seen = set()
-        filtered_titles = []
-        filtered_authors = []
-
-        for title, author_group in zip(titles, authors):
-            if title not in seen:
-                seen.add(title)
-                filtered_titles.append(title)
-                filtered_authors.append(author_group)
-
-        row['doc_title'] = str(filtered_titles)
-        row['doc_authors'] = str(filtered_authors)
-        return row
-    return df.apply(process_row, axis=1)
+    if Path(filename + '.parquet').exists():
+        return read_parquet(filename + '.parquet')
+    return list_to_string(read_tsv(filename + '.tsv'))
 
 
 def snorkel_to_intent_category(df):
@@ -47,10 +31,12 @@ def snorkel_to_intent_category(df):
 
 
 def snorkel_apply(df):
-    applier = PandasLFApplier(lfs=lfs)
-    L_train = applier.apply(df=df)
-    label_model = LabelModel(cardinality=2, verbose=True)
-    label_model.fit(L_train=L_train, n_epochs=500, log_freq=100)
+    """
+    Fit the label model on the training queries and save it, so that it is fitted only once for all predictions
+    """
+    L_train = apply_lfs(df, lfs)
+    label_model = fit_label_model(L_train)
+    save_label_model(label_model, lfs)
     preds = label_model.predict(L=L_train)
     df['snorkel_intent'] = preds
     probs = label_model.predict_proba(L=L_train)
@@ -65,7 +51,7 @@ EXPLORATORY = -1
 @labeling_function()
 def lf_query_in_title_if_long(x):
     query = x.query_text.lower()
-    title = x.doc_title.lower()
+    title = nested_text(x.doc_title).lower()
     if len(query.split()) > 2 and query in title:
         return NAVIGATIONAL
     return EXPLORATORY
@@ -79,7 +65,7 @@ def lf_query_in_authors(x):
     """
     query = x.query_text.lower().strip()
     try:
-        author_groups = ast.literal_eval(x.doc_authors)
+        author_groups = nested_list(x.doc_authors)
     except (ValueError, SyntaxError, TypeError):
         return EXPLORATORY
     if not isinstance(author_groups, list):
@@ -91,7 +77,7 @@ def lf_query_in_authors(x):
         for author in group:
             if not isinstance(author, dict):
                 continue
-            author_name = author.get('name', '').lower()
+            author_name = (author.get('name') or '').lower()
             if query == author_name or query in author_name:
                 matched_groups += 1
                 break  # Only count once per group
@@ -112,15 +98,19 @@ def placeholder_no_clicks(x):
     return EXPLORATORY
 
 
+lfs = [lf_query_in_title_if_long, lf_query_in_authors, lf_low_clicks_navigational]
+
+
 if __name__ == '__main__':
-    df_queries = read_tsv("data/output/docs_grouped_by_queries.tsv")
-    df_queries_auth_title_string = list_to_string(df_queries)
-    df_unique_authors_same_paper = remove_duplicate_authors(df_queries_auth_title_string)
-    lfs = [lf_query_in_title_if_long, lf_query_in_authors, lf_low_clicks_navigational]
+    # the label model is fitted on the label matrix of apply_lfs, which has to match the labelling functions
+    check_parity(parity_fixture(), lfs)
+    df_queries = read_docs_grouped_by_queries()
+    df_unique_authors_same_paper = remove_duplicate_authors(df_queries)
     df_snorkel_pred = snorkel_apply(df_unique_authors_same_paper)
     df_final_intent = snorkel_to_intent_category(df_snorkel_pred)
     print(df_final_intent['snorkel_intent'])
-    write_tsv(df_final_intent,"data/output/longeval25_sci_train_intent.tsv")
+    write_parquet(df_final_intent,"data/output/longeval25_sci_train_intent.parquet")
+    write_trace(finished, "data/output/longeval25_sci_train_intent-trace.json")
 
     navigational_count = df_final_intent['snorkel_intent'].value_counts().get('navigational', 0)
     print(f"Number of navigational labels: {navigational_count}")
@@ -0,0 +1,162 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from snorkel.labeling import PandasLFApplier
+from preprocessing_train import nested_list, nested_text
+from longeval_common.spans import span
+
+NAVIGATIONAL = 1
+EXPLORATORY = -1
+
+
+def query_in_title_if_long(df):
+    """
+    Columnar version of lf_query_in_title_if_long
+    """
+    queries = df['query_text'].str.lower()
+    long_queries = (queries.str.split().str.len() > 2).to_numpy()
+    titles = df['doc_title'].map(nested_text).str.lower()
+    matches = np.fromiter(
+        (long_query and query in title for long_query, query, title in zip(long_queries, queries, titles)),
+        dtype=bool, count=len(df)
+    )
+    return np.where(matches, NAVIGATIONAL, EXPLORATORY)
+
+
+def author_groups(doc_authors):
+    """
+    The lower-cased author names per author group of a doc_authors value, or None if it can not be parsed
+    """
+    try:
+        groups = nested_list(doc_authors)
+    except (ValueError, SyntaxError, TypeError):
+        return None
+    if not isinstance(groups, list):
+        return None
+    return [
+        [(author.get('name') or '').lower() for author in group if isinstance(author, dict)]
+        for group in groups if isinstance(group, list)
+    ]
+
+
+def author_name_index(doc_authors):
+    """
+    Flattens the author names of all rows into the arrays (group, name) and the row of each group.
+    Every distinct doc_authors string is parsed only once, native lists are not parsed at all.
+    """
+    parsed = {}
+    group_rows = []
+    name_groups = []
+    names = []
+    for row, value in enumerate(doc_authors):
+        if not isinstance(value, str):
+            groups = author_groups(value)
+        else:
+            if value not in parsed:
+                parsed[value] = author_groups(value)
+            groups = parsed[value]
+        for group in groups or []:
+            for name in group:
+                name_groups.append(len(group_rows))
+                names.append(name)
+            group_rows.append(row)
+    return np.array(group_rows, dtype=np.int64), np.array(name_groups, dtype=np.int64), names
+
+
+def query_in_authors(df):
+    """
+    Columnar version of lf_query_in_authors
+    """
+    queries = df['query_text'].str.lower().str.strip().to_numpy()
+    group_rows, name_groups, names = author_name_index(df['doc_authors'])
+    name_rows = group_rows[name_groups]
+    matches = np.fromiter(
+        (queries[row] in name for row, name in zip(name_rows, names)),
+        dtype=bool, count=len(names)
+    )
+    # every author group counts only once, no matter how many of its authors match
+    matched_groups = np.bincount(group_rows[np.unique(name_groups[matches])], minlength=len(df))
+    return np.where(matched_groups == 1, NAVIGATIONAL, EXPLORATORY)
+
+
+def low_clicks_navigational(df):
+    """
+    Columnar version of lf_low_clicks_navigational
+    """
+    return np.where(df['nb_clicks'] <= 3, NAVIGATIONAL, EXPLORATORY)
+
+
+# The columnar implementations of the labelling functions by the name of the labelling function
+VECTORISED_LFS = {
+    'lf_query_in_title_if_long': query_in_title_if_long,
+    'lf_query_in_authors': query_in_authors,
+    'lf_low_clicks_navigational': low_clicks_navigational,
+}
+
+
+def apply_lfs(df, lfs):
+    """
+    The label matrix L of the labelling functions on df, as PandasLFApplier(lfs).apply(df) would return it.
+    Labelling functions without a columnar implementation are applied row by row.
+    """
+    columns = []
+    with span('lf application', len(df)):
+        for lf in lfs:
+            if lf.name in VECTORISED_LFS:
+                columns.append(VECTORISED_LFS[lf.name](df))
+            else:
+                columns.append(np.array([lf(x) for _, x in df.iterrows()], dtype=int))
+    return np.column_stack(columns).astype(int)
+
+
+def check_parity(df, lfs):
+    """
+    Raises a ValueError if apply_lfs and the PandasLFApplier of snorkel produce different label matrices
+    """
+    expected = PandasLFApplier(lfs=lfs).apply(df=df, progress_bar=False)
+    actual = apply_lfs(df, lfs)
+    if expected.shape != actual.shape:
+        raise ValueError(f'Label matrix has shape {actual.shape} instead of {expected.shape}.')
+    for i, lf in enumerate(lfs):
+        mismatches = np.flatnonzero(expected[:, i] != actual[:, i])
+        if len(mismatches) > 0:
+            raise ValueError(f'{lf.name} labels {len(mismatches)} rows differently, e.g., row {mismatches[0]}.')
+
+
+def parity_fixture():
+    """
+    A handful of queries that cover the cases of the labelling functions: titles and authors as native lists and
+    as strings (as read from TSV), authors that are None or can not be parsed, malformed author groups, queries
+    that match the authors of one or of several groups, and the thresholds of the query length and the clicks
+    """
+    authors = [[{'name': 'Jane Doe'}, {'name': 'Max Mustermann'}], [{'name': 'John Doe'}]]
+    rows = [
+        ('deep learning for graphs', ['A survey of deep learning for graphs', 'Graphs'], authors, 1),
+        ('deep learning for graphs', str(['A survey of Deep Learning for Graphs', 'Graphs']), str(authors), 2),
+        ('graphs learning with', ['Graphs', 'Learning with graphs', None], authors, 2),
+        ('learning graphs', ['Learning graphs'], authors, 3),
+        ('doe', ['Paper'], authors, 4),
+        ('doe', ['Paper'], str(authors), 3),
+        (' Jane Doe ', ['Paper'], authors, 5),
+        ('jane doe', ['Paper'], str(authors), 1),
+        ('mustermann', ['Paper', 'Other paper'], [[{'name': 'Max Mustermann'}], [{'name': 'Erika Mustermann'}, {'name': None}]], 2),
+        ('jane doe', ['Paper'], None, 1),
+        ('jane doe', ['Paper'], "[[{'name': 'Jane Doe'}", 1),
+        ('jane doe', ['Paper'], "{'name': 'Jane Doe'}", 1),
+        ('jane doe', ['Paper'], [[{'name': 'Jane Doe'}, 'Jane Doe'], 'Jane Doe', [{}]], 1),
+        ('jane doe', ['Paper'], [], 0),
+    ]
+    return pd.DataFrame(rows, columns=['query_text', 'doc_title', 'doc_authors', 'nb_clicks'])
+
+
+if __name__ == '__main__':
+    from snorkel_labelling_train import lfs
+    check_parity(parity_fixture(), lfs)
+    print(f'Vectorised labelling functions produce the same label matrix on the {len(parity_fixture())} queries of the fixture.')
+
+    # Parity check on the preprocessed training queries in data/output/docs_grouped_by_queries.parquet (or .tsv)
+    from snorkel_labelling_train import read_docs_grouped_by_queries, remove_duplicate_authors
+    if any(Path(f'data/output/docs_grouped_by_queries.{i}').exists() for i in ['parquet', 'tsv']):
+        df = remove_duplicate_authors(read_docs_grouped_by_queries())
+        check_parity(df, lfs)
+        print(f'Vectorised labelling functions produce the same label matrix on {len(df)} queries.')
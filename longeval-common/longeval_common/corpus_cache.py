@@ -0,0 +1,152 @@
+"""
+A columnar cache of the documents of a snapshot, so that the corpus is parsed from docs_iter only once and not by
+every indexing, splitting, or preprocessing run. The documents of a snapshot are converted once into an
+uncompressed Arrow IPC file in the order of docs_iter. The file is memory-mapped, i.e., reading it does not copy
+the data, and only the projected columns are touched. The cache directory can be shared by all subprojects.
+"""
+import hashlib
+import os
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+CORPUS_FILE = "docs.arrow"
+CORPUS_BATCH_SIZE = 10000
+
+# default_text() of the document as text, the remaining columns are the fields of the documents of LongEval-Sci,
+# documents without a field (e.g., of LongEval-Web) have null values.
+SCHEMA = pa.schema([
+    ("doc_id", pa.string()),
+    ("text", pa.string()),
+    ("title", pa.string()),
+    ("abstract", pa.string()),
+    ("authors", pa.list_(pa.struct([("name", pa.string())]))),
+    ("links", pa.list_(pa.map_(pa.string(), pa.string()))),
+])
+
+
+def record_batch(docs):
+    columns = {
+        "doc_id": [i.doc_id for i in docs],
+        "text": [i.default_text() for i in docs],
+        "title": [getattr(i, "title", None) for i in docs],
+        "abstract": [getattr(i, "abstract", None) for i in docs],
+        "authors": [getattr(i, "authors", None) for i in docs],
+        "links": [None if getattr(i, "links", None) is None else [list(link.items()) for link in i.links] for i in docs],
+    }
+    return pa.record_batch([pa.array(columns[i.name], i.type) for i in SCHEMA], schema=SCHEMA)
+
+
+def build_corpus(ir_dataset, directory, batch_size=CORPUS_BATCH_SIZE):
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_file = directory / f"{CORPUS_FILE}.{os.getpid()}.tmp"
+    with pa.OSFile(str(tmp_file), "wb") as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+        batch = []
+        for doc in ir_dataset.docs_iter():
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                writer.write_batch(record_batch(batch))
+                batch = []
+        if batch:
+            writer.write_batch(record_batch(batch))
+    # the corpus file exists only when it is complete
+    os.replace(tmp_file, directory / CORPUS_FILE)
+
+
+class Corpus:
+    """
+    Read-only view of the memory-mapped corpus file of a snapshot with column projection.
+    """
+    def __init__(self, corpus_file):
+        self.corpus_file = Path(corpus_file)
+        self.source = pa.memory_map(str(corpus_file))
+        self.table = pa.ipc.open_file(self.source).read_all()
+        # The lookup of doc_id -> row is built on first use by rows_of
+        self.row_lookup = None
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def doc_ids(self):
+        return self.table.column("doc_id")
+
+    def iter_dicts(self, columns, batch_size=CORPUS_BATCH_SIZE, start=0, stop=None):
+        """
+        The documents (of the rows start to stop) as dicts, in the order of docs_iter. columns is a list of columns or
+        a dict from columns to the keys of the dicts, e.g., {"doc_id": "docno", "text": "text"} for an indexer.
+        """
+        columns = columns if isinstance(columns, dict) else {i: i for i in columns}
+        table = self.table.slice(start, None if stop is None else max(0, stop - start))
+        for batch in table.select(list(columns)).to_batches(max_chunksize=batch_size):
+            values = [batch.column(i).to_pylist(maps_as_pydicts="lossy") for i in columns]
+            for row in zip(*values):
+                yield dict(zip(columns.values(), row))
+
+    def rows_of(self, doc_ids):
+        """
+        The rows of the doc_ids, -1 for unknown doc_ids. The hash table of all doc_ids is built only once per corpus,
+        on the first lookup, and a doc_id that occurs several times is looked up at its first row.
+        """
+        if self.row_lookup is None:
+            all_doc_ids = pd.Index(self.doc_ids().to_pandas())
+            first = ~all_doc_ids.duplicated()
+            self.row_lookup = (all_doc_ids[first], np.flatnonzero(first))
+        index, rows = self.row_lookup
+        positions = index.get_indexer(doc_ids)
+        return np.where(positions >= 0, rows[positions], -1)
+
+    def get_many(self, doc_ids, columns=("doc_id", "title", "abstract", "authors")):
+        """
+        The documents with the doc_ids as doc_id -> named tuple of the columns, like docs_store().get_many.
+        Unknown doc_ids are left out.
+        """
+        doc_ids = list(doc_ids)
+        rows = self.rows_of(doc_ids)
+        found = rows >= 0
+        documents = self.table.select(list(columns)).take(pa.array(rows[found]))
+
+        document = namedtuple("Document", columns)
+        values = [documents.column(i).to_pylist(maps_as_pydicts="lossy") for i in columns]
+        return dict(zip((i for i, j in zip(doc_ids, found) if j), (document(*i) for i in zip(*values))))
+
+    def to_pandas(self, columns):
+        """
+        The projected columns as data frame, nested columns as native python lists.
+        """
+        table = self.table.select(list(columns))
+        df = table.to_pandas()
+        for field in table.schema:
+            if pa.types.is_nested(field.type):
+                df[field.name] = table.column(field.name).to_pylist(maps_as_pydicts="lossy")
+        return df
+
+
+def corpus_key(ir_dataset):
+    """
+    The name of the directory of a snapshot in the cache directory: its snapshot and a hash of the location of its
+    documents (the base_path of LongEval datasets or the docs_path of other ir_datasets), as local datasets may
+    have no snapshot name and datasets of different collections the same one. Raises a ValueError for datasets
+    that have neither a location nor a snapshot name, as they can not be told apart.
+    """
+    snapshot = ir_dataset.get_snapshot()
+    location = getattr(ir_dataset, "base_path", None)
+    if location is None and hasattr(ir_dataset, "docs_path"):
+        location = ir_dataset.docs_path()
+    if location is None:
+        if not snapshot:
+            raise ValueError(f"The documents of {ir_dataset!r} can not be cached, it has neither a snapshot nor a base_path or docs_path.")
+        return snapshot
+    return f"{snapshot or 'corpus'}-{hashlib.sha256(str(Path(location).resolve()).encode()).hexdigest()[:16]}"
+
+
+def get_corpus(ir_dataset, cache_directory):
+    """
+    The corpus of the snapshot from the cache directory, it is converted on first use.
+    """
+    directory = Path(cache_directory) / corpus_key(ir_dataset)
+    if not (directory / CORPUS_FILE).exists():
+        build_corpus(ir_dataset, directory)
+    return Corpus(directory / CORPUS_FILE)
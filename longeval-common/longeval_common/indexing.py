@@ -0,0 +1,321 @@
+"""
+Building and opening the Terrier indexes of the snapshots, shared by the retrieval subprojects. The index of a
+snapshot is a single Terrier index or consists of several segments (e.g., the shards of a sharded index) that are
+served together as one Terrier MultiIndex. How an index is built and loaded is configured with IndexOptions.
+"""
+import hashlib
+import multiprocessing
+import unicodedata
+from collections import namedtuple
+from itertools import cycle, islice
+from queue import Empty, Full
+
+import pyterrier as pt
+
+from longeval_common.corpus_cache import Corpus, get_corpus
+from longeval_common.snapshots import load_snapshot
+from longeval_common.spans import counted, span, tracked
+
+
+# Index structures that are read from disk on demand with the "disk" index loading policy
+DISK_INDEX_PROPERTIES = {
+    "index.meta.index-source": "file",
+    "index.meta.data-source": "file",
+    "index.lexicon.data-source": "file",
+    "index.inverted.data-source": "file",
+}
+
+
+# Maximum length of the document text in the meta index
+META_TEXT_LENGTH = 20480
+# Documents that a prefetching worker prepares or that are sent to an index shard at once, and batches per worker
+# or shard that are queued ahead of its indexer
+PREFETCH_BATCH_SIZE = 1000
+PREFETCH_BATCHES = 4
+
+
+class IndexOptions(namedtuple("IndexOptions", ["shards", "index_loading", "meta_text", "corpus_cache", "prefetch_workers", "normalise_text", "truncate_text"], defaults=[1, "default", True, None, 0, False, False])):
+    """
+    How the index of a snapshot is built and loaded: the number of shards that are built in parallel, the index
+    loading policy (see open_index), whether the text is stored in the meta index, the directory of the columnar
+    corpus cache, the number of prefetching workers, and whether the text is normalised and truncated.
+    """
+
+
+def get_indexer(index_directory, meta_text=True):
+    # The text is only needed by re-rankers that work on the document text, not by the first stage retrieval
+    meta = {"docno": 100, "text": META_TEXT_LENGTH} if meta_text else {"docno": 100}
+
+    return pt.IterDictIndexer(
+        str(index_directory), overwrite=True, meta=meta, properties={"metaindex.compressed.reverse.allow.duplicates": True}
+    )
+
+
+def get_index(ir_dataset, index_directory, options=IndexOptions(), *, dataset=None):
+    """
+    The index of a snapshot, it is built on first use. The dataset id is only needed by prefetching workers
+    without a corpus cache, which load the snapshot themselves.
+    """
+    # PyTerrier needs an absolute path
+    index_directory = index_directory.resolve().absolute()
+
+    if read_segments(index_directory) is None:
+        if options.shards > 1:
+            build_sharded_index(ir_dataset, index_directory, options)
+        else:
+            build_index(ir_dataset, index_directory, options, dataset=dataset)
+
+    return open_segments(read_segments(index_directory), options.index_loading)
+
+
+def normalise_document_text(text):
+    # compatibility characters (e.g., ligatures or full-width forms) as their canonical equivalents, all whitespace as a single space
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def prepare_docs(docs, normalise_text=False, truncate_text=False):
+    for doc in docs:
+        if normalise_text:
+            doc["text"] = normalise_document_text(doc["text"])
+        if truncate_text:
+            doc["text"] = doc["text"][:META_TEXT_LENGTH]
+        yield doc
+
+
+def iter_docs(ir_dataset, corpus_cache=None, normalise_text=False, truncate_text=False):
+    """
+    The documents of a snapshot as input for the indexer, read from the columnar corpus cache if there is one.
+    """
+    if corpus_cache:
+        docs = get_corpus(ir_dataset, corpus_cache).iter_dicts({"doc_id": "docno", "text": "text"})
+    else:
+        docs = ({"docno": i.doc_id, "text": i.default_text()} for i in ir_dataset.docs_iter())
+    return prepare_docs(docs, normalise_text, truncate_text)
+
+
+def prefetch_worker(dataset, snapshot, corpus_file, normalise_text, truncate_text, worker, workers, queue):
+    """
+    Runs in its own worker process: prepares the batches worker, worker + workers, ... of the documents and puts
+    them into the bounded queue, which blocks while the indexer is behind. None marks the end.
+    """
+    try:
+        if corpus_file:
+            # the columnar corpus can be sliced, so every worker reads only its own batches
+            corpus = Corpus(corpus_file)
+            batches = (
+                list(corpus.iter_dicts({"doc_id": "docno", "text": "text"}, start=start, stop=start + PREFETCH_BATCH_SIZE))
+                for start in range(worker * PREFETCH_BATCH_SIZE, len(corpus), workers * PREFETCH_BATCH_SIZE)
+            )
+        else:
+            # the documents can only be parsed as a whole, so there is a single worker that parses all of them
+            docs = iter(load_snapshot(dataset, snapshot).docs_iter())
+            batches = iter(lambda: [{"docno": i.doc_id, "text": i.default_text()} for i in islice(docs, PREFETCH_BATCH_SIZE)], [])
+        for batch in batches:
+            queue.put(list(prepare_docs(batch, normalise_text, truncate_text)))
+        queue.put(None)
+    except Exception as e:
+        queue.put(e)
+
+
+def prefetch_docs(dataset, snapshot, workers, corpus_file=None, normalise_text=False, truncate_text=False):
+    """
+    The documents of a snapshot as input for the indexer, parsed and prepared ahead of the indexer by worker
+    processes, so that parsing overlaps with indexing. The batches of the workers are consumed round-robin, so
+    that the documents keep the order of docs_iter.
+    """
+    if workers > 1 and not corpus_file:
+        raise ValueError("Without a corpus cache, every prefetching worker would parse all documents, so there can only be one.")
+
+    # the JVM does not survive a fork, so every worker starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=PREFETCH_BATCHES) for _ in range(workers)]
+    processes = [
+        context.Process(target=prefetch_worker, args=(dataset, snapshot, corpus_file, normalise_text, truncate_text, i, workers, queues[i]), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for worker in cycle(range(workers)):
+            while True:
+                try:
+                    batch = queues[worker].get(timeout=10)
+                    break
+                except Empty:
+                    if not processes[worker].is_alive():
+                        raise RuntimeError(f"The prefetching worker {worker} died with the exit code {processes[worker].exitcode}.")
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def iter_doc_ids(ir_dataset, corpus_cache=None):
+    if corpus_cache:
+        return get_corpus(ir_dataset, corpus_cache).doc_ids().to_pylist()
+    return (i.doc_id for i in ir_dataset.docs_iter())
+
+
+def build_index(ir_dataset, index_directory, options=IndexOptions(), *, dataset=None):
+    with tracked(index_directory / "index-ir-metadata.yml", "indexing"):
+        indexer = get_indexer(index_directory, options.meta_text)
+
+        if options.prefetch_workers:
+            if dataset is None and not options.corpus_cache:
+                raise ValueError("The prefetching workers load the snapshot by its dataset id, but no dataset id was given.")
+            # the corpus is converted before the workers read it in parallel
+            corpus_file = get_corpus(ir_dataset, options.corpus_cache).corpus_file if options.corpus_cache else None
+            docs = prefetch_docs(dataset, ir_dataset.get_snapshot(), options.prefetch_workers, corpus_file, options.normalise_text, options.truncate_text)
+        else:
+            docs = iter_docs(ir_dataset, options.corpus_cache, options.normalise_text, options.truncate_text)
+        with span("terrier indexing"):
+            indexer.index(counted(docs, "document iteration"))
+
+
+def index_shard(shard_directory, meta_text, queue=None, corpus_file=None, start=0, stop=None, normalise_text=False, truncate_text=False):
+    # Runs in its own worker process, i.e., with its own JVM, and indexes the rows start to stop of the columnar
+    # corpus or, without one, the batches of documents of its queue
+    indexer = get_indexer(shard_directory, meta_text)
+    if corpus_file:
+        docs = Corpus(corpus_file).iter_dicts({"doc_id": "docno", "text": "text"}, start=start, stop=stop)
+        indexer.index(prepare_docs(docs, normalise_text, truncate_text))
+    else:
+        indexer.index(doc for batch in iter(queue.get, None) for doc in batch)
+
+
+def put_to_worker(queue, item, process):
+    # the bounded queue blocks while the worker is behind, but a worker that died would block it forever
+    while True:
+        try:
+            queue.put(item, timeout=10)
+            return
+        except Full:
+            if not process.is_alive():
+                raise RuntimeError(f"The worker process {process.name} died with the exit code {process.exitcode}.")
+
+
+def build_sharded_index(ir_dataset, index_directory, options):
+    """
+    Build one partial index per shard in parallel worker processes. With a corpus cache, every shard reads only
+    its own contiguous slice of the columnar corpus. Otherwise, the documents are parsed only once, by this
+    process, which sends them batch-wise round-robin to the shards. The shards are served together as a
+    Terrier MultiIndex, which sums the collection and term statistics of all shards, so that BM25 and PL2
+    see the same global statistics as for a single index.
+    """
+    shards = options.shards
+    shard_directories = [index_directory / f"shard-{i}" for i in range(shards)]
+    index_directory.mkdir(parents=True, exist_ok=True)
+
+    # the JVM does not survive a fork, so every shard starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    if options.corpus_cache:
+        corpus = get_corpus(ir_dataset, options.corpus_cache)
+        bounds = [len(corpus) * i // shards for i in range(shards + 1)]
+        processes = [
+            context.Process(
+                target=index_shard, name=f"shard-{i}", args=(shard_directories[i], options.meta_text),
+                kwargs={"corpus_file": corpus.corpus_file, "start": bounds[i], "stop": bounds[i + 1], "normalise_text": options.normalise_text, "truncate_text": options.truncate_text},
+            )
+            for i in range(shards)
+        ]
+    else:
+        queues = [context.Queue(maxsize=PREFETCH_BATCHES) for _ in range(shards)]
+        processes = [
+            context.Process(target=index_shard, args=(shard_directories[i], options.meta_text, queues[i]), name=f"shard-{i}")
+            for i in range(shards)
+        ]
+
+    with tracked(index_directory / "index-ir-metadata.yml", "sharded indexing"):
+        for process in processes:
+            process.start()
+        try:
+            if not options.corpus_cache:
+                docs = iter(counted(iter_docs(ir_dataset, normalise_text=options.normalise_text, truncate_text=options.truncate_text), "document iteration"))
+                batches = iter(lambda: list(islice(docs, PREFETCH_BATCH_SIZE)), [])
+                for shard, batch in zip(cycle(range(shards)), batches):
+                    put_to_worker(queues[shard], batch, processes[shard])
+                for shard in range(shards):
+                    put_to_worker(queues[shard], None, processes[shard])
+            with span("terrier indexing"):
+                for process in processes:
+                    process.join()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+        failed = [i.name for i in processes if i.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Indexing failed for the shards {', '.join(failed)}.")
+
+    # segments.txt is written last, its existence marks a complete sharded index
+    (index_directory / "segments.txt").write_text("".join(str(i.relative_to(index_directory.parent)) + "\n" for i in shard_directories))
+
+
+def read_segments(index_directory):
+    """
+    The segments (i.e., Terrier indexes) that together hold all documents of a snapshot, oldest first: the
+    shards of a sharded index, the segments of an incremental index, or the index itself.
+    """
+    if (index_directory / "segments.txt").exists():
+        return [index_directory.parent / i.strip() for i in (index_directory / "segments.txt").read_text().splitlines() if i.strip()]
+    if (index_directory / "data.properties").exists():
+        return [index_directory]
+    return None
+
+
+def open_index(index_directory, index_loading="default"):
+    """
+    Open an index with one of the index loading policies:
+    "default" keeps the defaults of PyTerrier, "memory" loads all index structures into memory,
+    and "disk" reads postings, lexicon and meta data from disk on demand, so that only the parts
+    that are used are held in the OS page cache.
+    """
+    if index_loading == "memory":
+        return pt.IndexFactory.of(str(index_directory), memory=True)
+
+    if index_loading == "disk":
+        # The index.* properties of Terrier's global configuration override the data.properties of an index when
+        # it is loaded, so nothing is preloaded into memory and no changed properties are written to the index.
+        # The policy applies to all indexes that are opened in this process.
+        for key, value in DISK_INDEX_PROPERTIES.items():
+            pt.set_property(key, value)
+
+    index = pt.IndexFactory.of(str(index_directory))
+    if index_loading == "disk":
+        # the meta index is the largest structure, make sure that it is not held in memory after all
+        meta_index = index.getMetaIndex().getClass().getName()
+        data_source = index.getIndexProperty("index.meta.data-source", "file")
+        if "InMemory" in meta_index or data_source != "file":
+            raise ValueError(f"The meta index of {index_directory} is held in memory ({meta_index}, data source {data_source}) despite --index-loading disk.")
+
+    return index
+
+
+def open_segments(segments, index_loading="default"):
+    indexes = [open_index(i, index_loading) for i in segments]
+    if len(indexes) == 1:
+        return indexes[0]
+
+    return pt.java.autoclass("org.terrier.realtime.multi.MultiIndex")(indexes, False, False)
+
+
+def index_fingerprint(index_directory):
+    """
+    Fingerprint of the content of the index of a snapshot: the names and sizes of the files of its segments and
+    their properties, including the creation time of every segment. An index keeps its fingerprint wherever it is
+    copied to, but a rebuilt index gets a new one, even if its files have the same sizes.
+    """
+    fingerprint = hashlib.sha256()
+    for segment in read_segments(index_directory.resolve().absolute()):
+        for file in sorted(i for i in segment.iterdir() if i.is_file()):
+            fingerprint.update(f"{file.name}\t{file.stat().st_size}\n".encode())
+        properties = [i for i in (segment / "data.properties").read_text().splitlines() if not i.startswith("#")]
+        fingerprint.update("\n".join(sorted(properties)).encode())
+    return fingerprint.hexdigest()
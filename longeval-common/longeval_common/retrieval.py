@@ -0,0 +1,193 @@
+"""
+Tokenising the queries of the snapshots and writing the runs of a retriever, shared by the retrieval subprojects.
+The tokenised queries are cached next to the index directories of the snapshots, as queries repeat heavily from
+snapshot to snapshot.
+"""
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+from itertools import count, islice
+from shutil import copyfileobj, rmtree
+
+import pandas as pd
+import pyterrier as pt
+
+from longeval_common.indexing import index_fingerprint
+from longeval_common.spans import span
+
+
+# Separates the queries of a batch that is tokenised in a single call, the tokeniser keeps it as a token on its own
+QUERY_SEPARATOR = "qqqsepqqq"
+TOKENISATION_BATCH_SIZE = 1000
+
+# Tokenised queries by raw query text, shared by all snapshots that are processed in this process
+query_tokens = {}
+# Raw query texts that were tokenised since the cache file was last written
+new_query_tokens = set()
+
+
+def normalise_query(query_text):
+    return query_text.lower().strip()
+
+
+def read_query_tokens(cache_file):
+    if cache_file is not None and cache_file.exists():
+        with gzip.open(cache_file, "rt") as f:
+            query_tokens.update(json.load(f))
+
+
+def write_query_tokens(cache_file):
+    """
+    Merge the queries that were tokenised since the last write into the cache file. Snapshots that are processed
+    in parallel write the same cache file, so it is re-read and replaced under a lock.
+    """
+    if not new_query_tokens:
+        return
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file.with_name(f"{cache_file.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        read_query_tokens(cache_file)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with gzip.open(tmp_file, "wt") as f:
+            json.dump(query_tokens, f)
+        os.replace(tmp_file, cache_file)
+    new_query_tokens.clear()
+
+
+def query_tokens_file(index_directory):
+    # the cache file is shared by all snapshots of the index directory
+    return index_directory.resolve().parent / "query-tokens.json.gz"
+
+
+def tokenise_queries(queries, cache_file=None):
+    """
+    Tokenise queries with the Terrier tokeniser. Queries that are not yet in the cache are sent to the JVM
+    in batches, the results are memoised by raw query text and read from the cache_file, as queries repeat
+    heavily from snapshot to snapshot. New results are persisted once per snapshot with write_query_tokens.
+    """
+    if not query_tokens:
+        read_query_tokens(cache_file)
+
+    missing = sorted(set(queries) - query_tokens.keys())
+    if missing:
+        with span("jvm tokenisation", len(missing)):
+            tokeniser = pt.java.autoclass(
+                "org.terrier.indexing.tokenisation.Tokeniser"
+            ).getTokeniser()
+
+            for start in range(0, len(missing), TOKENISATION_BATCH_SIZE):
+                batch = missing[start:start + TOKENISATION_BATCH_SIZE]
+                tokenised = [[]]
+                for token in tokeniser.getTokens(f" {QUERY_SEPARATOR} ".join(batch)):
+                    if token == QUERY_SEPARATOR:
+                        tokenised.append([])
+                    else:
+                        tokenised[-1].append(token)
+
+                if len(tokenised) != len(batch):
+                    # a query contained the separator, fall back to one call per query
+                    tokenised = [tokeniser.getTokens(i) for i in batch]
+
+                query_tokens.update({query: " ".join(tokens) for query, tokens in zip(batch, tokenised)})
+        new_query_tokens.update(missing)
+
+    return [query_tokens[i] for i in queries]
+
+
+def get_topics(queries, index_directory, rewrite_queries=None):
+    """
+    The queries as topics with tokenised queries. rewrite_queries optionally rewrites the tokenised queries,
+    it gets them together with the raw query texts.
+    """
+    topics = pd.DataFrame([{"qid": i.query_id, "query": i.default_text()} for i in queries])
+    query_texts = topics["query"].tolist()
+
+    # PyTerrier needs to use pre-tokenized queries
+    topics["query"] = tokenise_queries(query_texts, query_tokens_file(index_directory))
+    if rewrite_queries:
+        topics["query"] = rewrite_queries(topics["query"].tolist(), query_texts)
+    return topics
+
+
+def retrieve(retriever, topics):
+    """
+    Multi-threaded retrieval returns the results in the order in which the queries complete. Sort them into
+    the order of the topics, so that the run is the same for any number of threads.
+    """
+    run = retriever(topics)
+    query_order = run["qid"].map({qid: position for position, qid in enumerate(topics["qid"])})
+
+    return run.assign(query_order=query_order).sort_values(["query_order", "rank"], kind="stable").drop(columns=["query_order"]).reset_index(drop=True)
+
+
+def write_run(ir_dataset, retriever, index_directory, output_directory, chunk_size=None, rewrite_queries=None, run_options=None):
+    """
+    Retrieve the queries of a snapshot and write the run to run.txt.gz, in chunks of chunk_size queries if given.
+    run_options are the JSON serialisable options that the results of the retriever depend on, e.g., the weighting
+    model. The queries that were tokenised for the first time are added to the query token cache afterwards.
+    """
+    if chunk_size:
+        retrieve_in_chunks(ir_dataset, retriever, index_directory, output_directory, chunk_size, rewrite_queries, run_options)
+    else:
+        topics = get_topics(ir_dataset.queries_iter(), index_directory, rewrite_queries)
+
+        with span("retrieval", len(topics)):
+            run = retrieve(retriever, topics)
+        with span("run writing", len(run)):
+            pt.io.write_results(run, output_directory / "run.txt.gz")
+    write_query_tokens(query_tokens_file(index_directory))
+
+
+def run_fingerprint(index_directory, chunk_size, run_options=None):
+    """
+    Fingerprint of everything that the chunks of a run depend on: the index, the chunk size, and the run_options.
+    """
+    fingerprint = hashlib.sha256(index_fingerprint(index_directory).encode())
+    fingerprint.update(json.dumps([chunk_size, run_options], sort_keys=True).encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def retrieve_in_chunks(ir_dataset, retriever, index_directory, output_directory, chunk_size, rewrite_queries=None, run_options=None):
+    """
+    Retrieve the queries chunk by chunk and write every chunk to its own run file as soon as it is complete,
+    so that only the results of one chunk are held in memory and an interrupted run resumes at the first
+    incomplete chunk. The chunks are concatenated into run.txt.gz once all of them are complete.
+    """
+    # chunks of runs with another index, chunk size, or run options are not reused
+    chunk_directory = output_directory / f"run-chunks-{run_fingerprint(index_directory, chunk_size, run_options)}"
+    chunk_directory.mkdir(parents=True, exist_ok=True)
+
+    queries = iter(ir_dataset.queries_iter())
+    chunk_files = []
+    for chunk in count():
+        queries_of_chunk = list(islice(queries, chunk_size))
+        if not queries_of_chunk:
+            break
+
+        chunk_file = chunk_directory / f"run-{chunk:06d}.txt.gz"
+        chunk_files.append(chunk_file)
+        if chunk_file.exists():
+            continue
+
+        topics = get_topics(queries_of_chunk, index_directory, rewrite_queries)
+
+        with span("retrieval", len(topics)):
+            run = retrieve(retriever, topics)
+        # a chunk file exists only when it is complete
+        tmp_file = chunk_directory / f"tmp-{chunk_file.name}"
+        with span("run writing", len(run)):
+            pt.io.write_results(run, tmp_file)
+        os.replace(tmp_file, chunk_file)
+
+    # concatenated gzip files are a valid gzip file
+    tmp_file = output_directory / "tmp-run.txt.gz"
+    with open(tmp_file, "wb") as f:
+        for chunk_file in chunk_files:
+            with open(chunk_file, "rb") as chunk:
+                copyfileobj(chunk, f)
+    os.replace(tmp_file, output_directory / "run.txt.gz")
+    # the chunks of interrupted runs with other options are obsolete as well
+    for i in output_directory.glob("run-chunks-*"):
+        rmtree(i)
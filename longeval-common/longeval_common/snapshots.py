@@ -0,0 +1,50 @@
+"""
+Loading the snapshots of a dataset and processing independent snapshots in parallel worker processes, shared by
+the retrieval subprojects. A snapshot is processed by the process_dataset function of a subproject, which gets the
+snapshot, its index and output directories, and the options of the run as keyword arguments.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from ir_datasets_longeval import load
+
+
+def load_snapshot(dataset, snapshot):
+    ir_dataset = load(dataset)
+    sub_collections = [ir_dataset] if not ir_dataset.get_datasets() else ir_dataset.get_datasets()
+
+    return [i for i in sub_collections if i.get_snapshot() == snapshot][0]
+
+
+def process_snapshot(process_dataset, dataset, snapshot, index, output, options):
+    # Runs in its own worker process, i.e., with its own JVM and its own tracking
+    process_dataset(load_snapshot(dataset, snapshot), index / snapshot, output / snapshot, **options)
+
+
+def process_snapshot_in_own_process(process_dataset, dataset, snapshot, index, output, options):
+    # A crashed worker process (e.g., of a crashed JVM) breaks its whole pool, so every snapshot gets a pool of its own.
+    # The JVM does not survive a fork, so the worker starts a fresh interpreter.
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        executor.submit(process_snapshot, process_dataset, dataset, snapshot, index, output, options).result()
+
+
+def process_snapshots_in_parallel(process_dataset, dataset, sub_collections, index, output, workers, options):
+    """
+    Process independent snapshots in up to workers processes at a time, one process per snapshot. A failed
+    snapshot, even one whose process crashed, does not stop the others, the failed snapshots are returned
+    together with their exceptions.
+    """
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process_snapshot_in_own_process, process_dataset, dataset, i.get_snapshot(), index, output, options): i.get_snapshot()
+            for i in sub_collections
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Snapshot {futures[future]} failed: {e!r}")
+                failed[futures[future]] = e
+
+    return failed
@@ -0,0 +1,167 @@
+"""
+Nested, named spans that record where the time and memory of a tracked block go: the wall clock and CPU time,
+the peak RSS of the process, and the number of items (documents, queries, ...) of every span. The spans of a
+tracked block are added to its ir-metadata and written as a trace in the Chrome trace event format next to it,
+which can be opened as a flame graph with https://ui.perfetto.dev or https://www.speedscope.app.
+
+Spans are recorded unless the environment variable SPANS is 0. When they are disabled, span and counted do not
+measure anything, so the instrumentation can stay in the code.
+"""
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from tirex_tracker import clear_metadata_register, register_metadata, tracking
+
+ENABLED = os.environ.get("SPANS", "1") != "0"
+
+# The finished spans of this process that are not yet exported by tracked, in the order in which they finished
+finished = []
+_active = threading.local()
+
+
+class Span:
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def add(self, items=1):
+        self.items = (self.items or 0) + items
+
+    def begin(self):
+        stack = _active.__dict__.setdefault("stack", [])
+        self.path = "/".join([i.name for i in stack] + [self.name])
+        self.depth = len(stack)
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def __enter__(self):
+        self.begin()
+        _active.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time += time.perf_counter() - self.start
+        self.cpu_time += time.process_time() - self.start_cpu
+        _active.stack.pop()
+        self.finish()
+
+    def finish(self):
+        # the peak RSS of the process until the end of the span, in KB on Linux
+        self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        finished.append(self)
+
+    def to_dict(self):
+        ret = {
+            "name": self.name,
+            "path": self.path,
+            "wallclock": f"{self.wall_time * 1000:.0f} ms",
+            "cpu": f"{self.cpu_time * 1000:.0f} ms",
+            "peak ram used process": f"{self.peak_rss} KB",
+        }
+        if self.items is not None:
+            ret["items"] = self.items
+            ret["items per second"] = round(self.items / self.wall_time, 1) if self.wall_time else None
+        return ret
+
+
+class NullSpan:
+    def add(self, items=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, items=None):
+    """
+    A span for a with block, nested into the span that is active in this thread. Items can be given in advance
+    or counted with add.
+    """
+    return Span(name, items) if ENABLED else NULL_SPAN
+
+
+def counted(iterable, name):
+    """
+    Iterate with a span that counts the items and accumulates only the time spent in producing them, e.g., the
+    time to parse documents that are consumed by an indexer. In traces, the accumulated time starts at the first
+    item, so it is nested correctly into flame graphs but not placed exactly on the time line.
+    """
+    if not ENABLED:
+        yield from iterable
+        return
+
+    # the span is not put on the stack of active spans, as the consumer runs between the items
+    ret = Span(name, 0)
+    ret.begin()
+    try:
+        iterator = iter(iterable)
+        while True:
+            start, start_cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                ret.wall_time += time.perf_counter() - start
+                ret.cpu_time += time.process_time() - start_cpu
+            ret.items += 1
+            yield item
+    finally:
+        ret.finish()
+
+
+def trace_events(spans):
+    """
+    The spans as complete events of the Chrome trace event format, with timestamps in microseconds.
+    """
+    return [{
+        "name": i.name,
+        "cat": i.path,
+        "ph": "X",
+        "ts": round(i.start * 1e6),
+        "dur": round(i.wall_time * 1e6),
+        "pid": os.getpid(),
+        "tid": i.thread,
+        "args": i.to_dict(),
+    } for i in sorted(spans, key=lambda i: (i.start, i.depth))]
+
+
+def write_trace(spans, trace_file):
+    Path(trace_file).parent.mkdir(parents=True, exist_ok=True)
+    Path(trace_file).write_text(json.dumps({"traceEvents": trace_events(spans), "displayTimeUnit": "ms"}))
+
+
+@contextmanager
+def tracked(export_file_path, name, **kwargs):
+    """
+    Track a block with the tirex tracker and record it as a span. The spans that finish within the block are
+    added to the exported ir-metadata and written as trace to the same file name with the suffix -trace.json.
+    """
+    export_file_path = Path(export_file_path)
+    first = len(finished)
+    try:
+        with tracking(export_file_path=export_file_path, **kwargs):
+            with span(name) as root:
+                yield root
+            if ENABLED:
+                spans = finished[first:]
+                register_metadata({"spans": [i.to_dict() for i in spans]})
+                write_trace(spans, export_file_path.with_name(f"{export_file_path.stem}-trace.json"))
+    finally:
+        # the spans of the block are exported, so they do not accumulate over all snapshots of a run
+        del finished[first:]
+        clear_metadata_register()
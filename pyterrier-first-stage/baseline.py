@@ -1,4 +1,9 @@
 #!/usr/bin/env python3
+import gzip
+import json
+import sqlite3
+import time
+import zlib
 from pathlib import Path
 from shutil import copy
 
@@ -7,76 +12,362 @@ import pandas as pd
 import pyterrier as pt
 from ir_datasets_longeval import load
 
-from tirex_tracker import tracking
+from longeval_common import indexing
+from longeval_common.indexing import META_TEXT_LENGTH, IndexOptions, build_index, get_indexer, index_fingerprint, iter_doc_ids, iter_docs, read_segments
+from longeval_common.retrieval import normalise_query, write_run
+from longeval_common.snapshots import process_snapshots_in_parallel
+from longeval_common.spans import counted, span, tracked
 
 
-def get_index(ir_dataset, index_directory):
-    # PyTerrier needs an absolute path
-    index_directory = index_directory.resolve().absolute()
+def get_index(ir_dataset, index_directory, options=IndexOptions(), *, dataset=None, incremental=False):
+    if incremental:
+        # PyTerrier needs an absolute path
+        build_incremental_index(ir_dataset, index_directory.resolve().absolute(), options)
 
-    if (
-        not index_directory.exists()
-        or not (index_directory / "data.properties").exists()
-    ):
-        with tracking(export_file_path=index_directory / "index-ir-metadata.yml"):
-            indexer = pt.IterDictIndexer(
-                str(index_directory), overwrite=True, meta={"docno": 100, "text": 20480}
-            )
+    return indexing.get_index(ir_dataset, index_directory, options, dataset=dataset)
 
-            docs = (
-                {"docno": i.doc_id, "text": i.default_text()}
-                for i in ir_dataset.docs_iter()
-            )
-            indexer.index(docs)
 
-    return pt.IndexFactory.of(str(index_directory))
+def get_prior_snapshot(ir_dataset):
+    prior_datasets = sorted(ir_dataset.get_prior_datasets() or [], key=lambda i: i.get_timestamp())
+    return prior_datasets[-1] if prior_datasets else None
 
 
-def process_dataset(ir_dataset, index_directory, output_directory):
-    if (output_directory / "run.txt.gz").exists():
+def read_docnos(file_name):
+    if not file_name.exists():
+        return set()
+    with gzip.open(file_name, "rt") as f:
+        return set(i.strip() for i in f if i.strip())
+
+
+def write_docnos(docnos, file_name):
+    with gzip.open(file_name, "wt") as f:
+        for docno in sorted(docnos):
+            f.write(docno + "\n")
+
+
+def get_docnos(ir_dataset, index_directory, corpus_cache=None):
+    if not (index_directory / "docnos.txt.gz").exists():
+        write_docnos(set(iter_doc_ids(ir_dataset, corpus_cache)), index_directory / "docnos.txt.gz")
+
+    return read_docnos(index_directory / "docnos.txt.gz")
+
+
+def build_incremental_index(ir_dataset, index_directory, options=IndexOptions()):
+    """
+    Index a snapshot on top of the index of its predecessor: only the documents that were added since the
+    predecessor go into a new segment, documents that were removed since the predecessor are masked at
+    retrieval time (see read_masked_docnos), and all segments are served together as one Terrier MultiIndex.
+    Collection statistics of the MultiIndex still count masked documents.
+    """
+    if read_segments(index_directory) is not None:
+        return
+
+    prior_snapshot = get_prior_snapshot(ir_dataset)
+    if prior_snapshot is None:
+        build_index(ir_dataset, index_directory, options)
         return
 
-    index = get_index(ir_dataset, index_directory)
-    with tracking(export_file_path=output_directory / "retrieval-ir-metadata.yml"):
-        retriever = pt.terrier.Retriever(index, wmodel="PL2")
+    prior_directory = index_directory.parent / prior_snapshot.get_snapshot()
+    build_incremental_index(prior_snapshot, prior_directory, options)
+    prior_docnos = get_docnos(prior_snapshot, prior_directory, options.corpus_cache)
+    prior_masked = read_docnos(prior_directory / "masked-docnos.txt.gz")
+
+    docnos = set(iter_doc_ids(ir_dataset, options.corpus_cache))
+    # documents that were removed and re-added are un-masked instead of indexed a second time
+    added = docnos - prior_docnos - prior_masked
+    masked = (prior_docnos | prior_masked) - docnos
+
+    segments = read_segments(prior_directory)
+    index_directory.mkdir(parents=True, exist_ok=True)
+    if added:
+        segment_directory = index_directory / "segment"
+        with tracked(index_directory / "index-ir-metadata.yml", "incremental indexing"):
+            indexer = get_indexer(segment_directory, options.meta_text)
+
+            docs = (i for i in iter_docs(ir_dataset, options.corpus_cache, options.normalise_text, options.truncate_text) if i["docno"] in added)
+            with span("terrier indexing"):
+                indexer.index(counted(docs, "document iteration"))
+        segments = segments + [segment_directory]
+    else:
+        copy(prior_directory / "index-ir-metadata.yml", index_directory / "index-ir-metadata.yml")
+
+    write_docnos(docnos, index_directory / "docnos.txt.gz")
+    write_docnos(masked, index_directory / "masked-docnos.txt.gz")
+    # segments.txt is written last, its existence marks a complete incremental index
+    (index_directory / "segments.txt").write_text("".join(str(i.relative_to(index_directory.parent)) + "\n" for i in segments))
+
+
+def read_masked_docnos(index_directory):
+    return read_docnos(index_directory.resolve().absolute() / "masked-docnos.txt.gz")
+
+
+def masked_retrieval(get_retriever, masked_docnos, num_results=1000):
+    """
+    Retrieve num_results documents per query that are still part of the snapshot. get_retriever(depth) returns a
+    retriever of depth results. All queries are retrieved num_results deep first. Only the queries that are left
+    with fewer than num_results documents after masking, although more documents could be retrieved, are
+    retrieved again, twice as deep every time. The depth grows with the masked documents in the top results of a
+    query and not with all masked documents of the snapshot.
+    """
+    def _retrieve(topics):
+        depth = num_results
+        run = get_retriever(depth)(topics)
+        runs = []
+        while True:
+            unmasked = run[~run["docno"].isin(masked_docnos)]
+            retrieved = run.groupby("qid").size()
+            left = unmasked.groupby("qid").size().reindex(retrieved.index, fill_value=0)
+            short = retrieved.index[(retrieved >= depth) & (left < num_results)]
+            runs.append(unmasked[~unmasked["qid"].isin(short)])
+            if len(short) == 0:
+                break
+            depth *= 2
+            run = get_retriever(depth)(topics[topics["qid"].isin(short)])
+
+        run = pd.concat(runs).sort_values(["qid", "rank"], kind="stable")
+        run["rank"] = run.groupby("qid").cumcount()
+        return run[run["rank"] < num_results].reset_index(drop=True)
+
+    return pt.apply.generic(_retrieve)
+
+
+# Months after which the relevance feedback of a prior snapshot counts only half for the history boost
+HISTORY_HALF_LIFE = 6
+
+
+def get_history(ir_dataset, half_life=HISTORY_HALF_LIFE):
+    """
+    The relevance feedback of the prior snapshots as (qid, docno, boost) for the queries of this snapshot: the
+    relevance of a document for the same normalised query text, decayed by the age of its snapshot in months
+    and summed over the prior snapshots.
+    """
+    timestamp = ir_dataset.get_timestamp()
+    history = []
+    for prior in ir_dataset.get_prior_datasets():
+        if not prior.has_qrels():
+            continue
+        age = (timestamp.year - prior.get_timestamp().year) * 12 + timestamp.month - prior.get_timestamp().month
+        query_texts = {i.query_id: normalise_query(i.default_text()) for i in prior.queries_iter()}
+        qrels = pd.DataFrame([(i.query_id, i.doc_id, i.relevance) for i in prior.qrels_iter()], columns=["query_id", "docno", "relevance"])
+        qrels = qrels[qrels["relevance"] > 0]
+        history.append(pd.DataFrame({
+            "query": qrels["query_id"].map(query_texts),
+            "docno": qrels["docno"],
+            "boost": qrels["relevance"] * 0.5 ** (age / half_life),
+        }))
+
+    queries = pd.DataFrame([(i.query_id, normalise_query(i.default_text())) for i in ir_dataset.queries_iter()], columns=["qid", "query"])
+    if not history:
+        return pd.DataFrame(columns=["qid", "docno", "boost"])
+    history = pd.concat(history).dropna(subset=["query"]).groupby(["query", "docno"], as_index=False)["boost"].sum()
+    return queries.merge(history, on="query")[["qid", "docno", "boost"]]
 
-        topics = pd.DataFrame(
-            [
-                {"qid": i.query_id, "query": i.default_text()}
-                for i in ir_dataset.queries_iter()
-            ]
+
+def history_boost(history, alpha):
+    """
+    Add alpha times the historical relevance feedback of a (qid, docno) pair to its score and re-rank, with one
+    merge of the whole result frame.
+    """
+    def _boost(run):
+        run = run.merge(history, on=["qid", "docno"], how="left")
+        run["score"] = run["score"] + alpha * run["boost"].fillna(0)
+        run = run.drop(columns=["boost"]).sort_values(["qid", "score"], ascending=[True, False], kind="stable")
+        run["rank"] = run.groupby("qid").cumcount()
+        return run.reset_index(drop=True)
+
+    return pt.apply.generic(_boost)
+
+# Maximum size in bytes of the compressed results in the result cache
+RESULT_CACHE_SIZE = 1024 ** 3
+# Number of queries that are looked up in the result cache with a single statement
+RESULT_CACHE_BATCH_SIZE = 500
+
+
+class ResultCache:
+    """
+    Persistent cache of the results of a query in SQLite, keyed by the index fingerprint, the weighting model,
+    the number of results, and the tokenised query. The least recently used results are evicted once the
+    compressed results exceed max_size bytes. Several processes can share the cache file.
+    """
+    def __init__(self, cache_file, max_size=RESULT_CACHE_SIZE):
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.connection = sqlite3.connect(cache_file, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (fingerprint TEXT, wmodel TEXT, num_results INTEGER, query TEXT, "
+            "results BLOB, size INTEGER, last_used REAL, PRIMARY KEY (fingerprint, wmodel, num_results, query))"
         )
+        self.connection.commit()
+
+    def get_many(self, key, queries):
+        """
+        The cached results of the queries as query -> [(docid, docno, score), ...] in the order of their rank.
+        """
+        ret = {}
+        queries = list(dict.fromkeys(queries))
+        for start in range(0, len(queries), RESULT_CACHE_BATCH_SIZE):
+            batch = queries[start:start + RESULT_CACHE_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT query, results FROM results WHERE fingerprint = ? AND wmodel = ? AND num_results = ? AND query IN ({', '.join('?' * len(batch))})",
+                (*key, *batch),
+            ).fetchall()
+            for query, results in rows:
+                ret[query] = json.loads(zlib.decompress(results))
+        if ret:
+            with self.connection:
+                self.connection.executemany(
+                    "UPDATE results SET last_used = ? WHERE fingerprint = ? AND wmodel = ? AND num_results = ? AND query = ?",
+                    [(time.time(), *key, query) for query in ret],
+                )
+        return ret
+
+    def put_many(self, key, query_results):
+        rows = []
+        for query, results in query_results.items():
+            compressed = zlib.compress(json.dumps(results).encode())
+            rows.append((*key, query, compressed, len(compressed), time.time()))
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.evict()
+
+    def evict(self):
+        excess = (self.connection.execute("SELECT SUM(size) FROM results").fetchone()[0] or 0) - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for rowid, size in self.connection.execute("SELECT rowid, size FROM results ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((rowid,))
+            excess -= size
+        self.connection.executemany("DELETE FROM results WHERE rowid = ?", evicted)
+
+    def close(self):
+        self.connection.close()
+
+
+def cached_retrieval(retriever, cache, key):
+    """
+    Look up the results of the topics in the result cache and retrieve only the queries that are not cached.
+    Topics with the same tokenised query share their cached results and are retrieved only once.
+    """
+    def _retrieve(topics):
+        results = cache.get_many(key, topics["query"])
+        # e.g., queries that differ only in case have the same tokenised query
+        misses = topics[~topics["query"].isin(results.keys())].drop_duplicates("query")
 
-        # PyTerrier needs to use pre-tokenized queries
-        tokeniser = pt.java.autoclass(
-            "org.terrier.indexing.tokenisation.Tokeniser"
-        ).getTokeniser()
+        if len(misses) > 0:
+            run = retriever(misses)
+            retrieved = {query: [] for query in misses["query"]}
+            for query, docid, docno, score in run.sort_values(["qid", "rank"])[["query", "docid", "docno", "score"]].itertuples(index=False):
+                retrieved[query].append((int(docid), docno, float(score)))
+            cache.put_many(key, retrieved)
+            results.update(retrieved)
 
-        topics["query"] = topics["query"].apply(
-            lambda i: " ".join(tokeniser.getTokens(i))
+        ranked = pd.DataFrame(
+            [(query, docid, docno, score, rank) for query in topics["query"].unique() for rank, (docid, docno, score) in enumerate(results[query])],
+            columns=["query", "docid", "docno", "score", "rank"],
         )
+        return topics[["qid", "query"]].merge(ranked, on="query")
 
-        run = retriever(topics)
-        pt.io.write_results(run, output_directory / "run.txt.gz")
-        copy(index_directory / "index-ir-metadata.yml", output_directory / "index-ir-metadata.yml")
+    return pt.apply.generic(_retrieve)
+
+
+def process_dataset(ir_dataset, index_directory, output_directory, index_options=IndexOptions(), *, incremental=False, dataset=None, chunk_size=None, threads=1, history_boost_alpha=0.0, result_cache=None, result_cache_size=RESULT_CACHE_SIZE):
+    if (output_directory / "run.txt.gz").exists():
+        return
+
+    index = get_index(ir_dataset, index_directory, index_options, dataset=dataset, incremental=incremental)
+    cache = ResultCache(result_cache, result_cache_size) if result_cache else None
+    try:
+        with tracked(output_directory / "retrieval-ir-metadata.yml", "retrieval run"):
+            masked_docnos = read_masked_docnos(index_directory) if incremental else set()
+            fingerprint = index_fingerprint(index_directory) if cache else None
+
+            def get_retriever(num_results):
+                retriever = pt.terrier.Retriever(index, wmodel="PL2", num_results=num_results, threads=threads)
+                if cache:
+                    retriever = cached_retrieval(retriever, cache, (fingerprint, "PL2", num_results))
+                return retriever
+
+            # masked documents are only made up for by retrieving the queries that lost documents deeper
+            retriever = masked_retrieval(get_retriever, masked_docnos) if masked_docnos else get_retriever(1000)
+
+            if history_boost_alpha:
+                with span("qrels loading"):
+                    history = get_history(ir_dataset)
+                retriever = retriever >> history_boost(history, history_boost_alpha)
+
+            run_options = {"wmodel": "PL2", "num_results": 1000, "incremental": incremental, "history_boost_alpha": history_boost_alpha}
+            write_run(ir_dataset, retriever, index_directory, output_directory, chunk_size, run_options=run_options)
+            copy(index_directory / "index-ir-metadata.yml", output_directory / "index-ir-metadata.yml")
+    finally:
+        # close the index of this snapshot before the index of the next snapshot is opened
+        index.close()
+        if cache:
+            cache.close()
 
 
 @click.command()
 @click.option("--dataset", type=str, help="The dataset id or a local directory.")
 @click.option("--output", type=Path, required=True, help="The output directory.")
 @click.option("--index", type=Path, required=True, help="The index directory.")
-def main(dataset, output, index):
+@click.option("--incremental", is_flag=True, help="Index only the documents that changed since the prior snapshot and reuse its index for the rest.")
+@click.option("--workers", type=int, default=1, help="The number of snapshots that are processed in parallel.")
+@click.option("--shards", type=int, default=1, help="The number of partial indexes that are built in parallel per snapshot.")
+@click.option("--chunk-size", type=int, default=None, help="Retrieve and write the run in chunks of this many queries. An interrupted run resumes at the last complete chunk.")
+@click.option("--threads", type=int, default=1, help="The number of threads that retrieve the queries of a snapshot from one shared index.")
+@click.option("--index-loading", type=click.Choice(["default", "memory", "disk"]), default="default", help="Load the index structures with the defaults of PyTerrier, into memory, or read them from disk on demand.")
+@click.option("--meta-text/--no-meta-text", default=True, help="Store the document text in the meta index of new indexes. The retrieval does not need it.")
+@click.option("--result-cache", type=Path, default=None, help="Cache the results of the queries in this SQLite file and retrieve only queries that are not cached for an identical index.")
+@click.option("--result-cache-size", type=int, default=RESULT_CACHE_SIZE // 1024 ** 2, help="The maximum size of the result cache in MB, the least recently used results are evicted.")
+@click.option("--corpus-cache", type=Path, default=None, help="Convert the documents of every snapshot once into a columnar file in this directory and index from it instead of parsing the corpus again.")
+@click.option("--prefetch-workers", type=int, default=0, help="The number of worker processes that parse and prepare the documents ahead of the indexer. More than one worker requires --corpus-cache. By default, the documents are parsed by the indexing process itself.")
+@click.option("--normalise-text", is_flag=True, help="Index the document text with NFKC unicode normalisation and collapsed whitespace.")
+@click.option("--truncate-text", is_flag=True, help=f"Index only the first {META_TEXT_LENGTH} characters of a document, the length of the text in the meta index.")
+@click.option("--history-boost", type=float, default=0.0, help="Add this weight times the relevance feedback of prior snapshots for the same query, decayed by the age of the snapshot, to the retrieval scores. Disabled by default.")
+def main(dataset, output, index, incremental, workers, shards, chunk_size, threads, index_loading, meta_text, result_cache, result_cache_size, corpus_cache, prefetch_workers, normalise_text, truncate_text, history_boost):
+    if incremental and workers > 1:
+        raise click.UsageError("--incremental indexes snapshots on top of each other, so they can not be processed in parallel.")
+    if incremental and shards > 1:
+        raise click.UsageError("--incremental indexes only the changed documents of a snapshot, so it can not be combined with --shards.")
+    if incremental and prefetch_workers:
+        raise click.UsageError("--incremental indexes only the changed documents of a snapshot, so it can not be combined with --prefetch-workers.")
+    if prefetch_workers and shards > 1:
+        raise click.UsageError("--shards feeds the documents to the index shards itself, so it can not be combined with --prefetch-workers.")
+    if prefetch_workers > 1 and not corpus_cache:
+        raise click.UsageError("Without --corpus-cache, every prefetching worker would parse all documents, so use --prefetch-workers 1 or add --corpus-cache.")
+
     ir_dataset = load(dataset)
     sub_collections = [ir_dataset] if not ir_dataset.get_datasets() else ir_dataset.get_datasets()
 
-    for snapshot in sub_collections:
-        process_dataset(snapshot, index / snapshot.get_snapshot(), output / snapshot.get_snapshot())
+    index_options = IndexOptions(
+        shards=shards, index_loading=index_loading, meta_text=meta_text, corpus_cache=corpus_cache,
+        prefetch_workers=prefetch_workers, normalise_text=normalise_text, truncate_text=truncate_text,
+    )
+    options = {
+        "index_options": index_options, "incremental": incremental, "dataset": dataset, "chunk_size": chunk_size,
+        "threads": threads, "history_boost_alpha": history_boost, "result_cache": result_cache,
+        "result_cache_size": result_cache_size * 1024 ** 2,
+    }
+
+    failed = {}
+    if workers > 1:
+        failed = process_snapshots_in_parallel(process_dataset, dataset, sub_collections, index, output, workers, options)
+    else:
+        for snapshot in sub_collections:
+            process_dataset(snapshot, index / snapshot.get_snapshot(), output / snapshot.get_snapshot(), **options)
 
     # The ir-metadata description of your approach
     ir_metadata = Path(__file__).parent / "ir-metadata.yml"
 
     copy(ir_metadata, output / "ir-metadata.yml")
 
+    if failed:
+        raise click.ClickException(f"Processing failed for the snapshots {', '.join(sorted(failed))}.")
+
 
 if __name__ == "__main__":
     main()
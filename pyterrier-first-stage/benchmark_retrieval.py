@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import json
+from pathlib import Path
+from time import perf_counter
+
+import click
+import pandas as pd
+import pyterrier as pt
+
+from baseline import get_index
+from longeval_common.retrieval import retrieve, tokenise_queries
+from longeval_common.snapshots import load_snapshot
+
+
+def benchmark(index, topics, wmodel, threads):
+    retriever = pt.terrier.Retriever(index, wmodel=wmodel, threads=threads)
+
+    start = perf_counter()
+    run = retrieve(retriever, topics)
+    seconds = perf_counter() - start
+
+    return run, {"wmodel": wmodel, "threads": threads, "queries": len(topics), "seconds": seconds, "queries_per_second": len(topics) / seconds}
+
+
+@click.command()
+@click.option("--dataset", type=str, required=True, help="The dataset id or a local directory.")
+@click.option("--snapshot", type=str, required=True, help="The snapshot of the dataset that is used for the benchmark.")
+@click.option("--index", type=Path, required=True, help="The index directory.")
+@click.option("--wmodel", type=str, multiple=True, default=["PL2", "BM25"], help="The weighting models to benchmark, PL2 for the baseline and BM25 for the keyqueries.")
+@click.option("--threads", type=int, multiple=True, default=[1, 2, 4, 8], help="The numbers of retrieval threads to benchmark.")
+@click.option("--output", type=Path, default=None, help="Optionally write the results as JSON to this file.")
+def main(dataset, snapshot, index, wmodel, threads, output):
+    ir_dataset = load_snapshot(dataset, snapshot)
+    index = get_index(ir_dataset, index / snapshot)
+
+    topics = pd.DataFrame([{"qid": i.query_id, "query": i.default_text()} for i in ir_dataset.queries_iter()])
+    topics["query"] = tokenise_queries(topics["query"].tolist())
+
+    results = []
+    for w in wmodel:
+        expected = None
+        for t in sorted(threads):
+            run, result = benchmark(index, topics, w, t)
+            # the run must not depend on the number of threads
+            if expected is None:
+                expected = run
+            result["identical_run"] = run[["qid", "docno", "rank"]].equals(expected[["qid", "docno", "rank"]])
+            results.append(result)
+            print(f"{w}\t{t} threads\t{result['queries_per_second']:.1f} queries/s\tidentical run: {result['identical_run']}")
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
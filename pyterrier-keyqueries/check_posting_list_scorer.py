@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import click
+import numpy as np
+
+from keyqueries import PostingListScorer
+
+
+def brute_force_ranks(posting_lists, target_docids):
+    """
+    The ranks of the targets in the full ranking of all documents that match a query term, as reference.
+    """
+    scores = {}
+    for docids, term_scores in posting_lists:
+        for docid, score in zip(docids.tolist(), term_scores.tolist()):
+            scores[docid] = scores.get(docid, 0.0) + score
+    ranking = sorted(scores, key=lambda i: (-scores[i], i))
+    return np.array([ranking.index(i) + 1 for i in target_docids.tolist() if i in scores], dtype=np.int64)
+
+
+def random_posting_lists(rng, documents, terms, targets_are_maximum):
+    """
+    Posting lists with random BM25-like scores. With targets_are_maximum, one target holds the maximum score of
+    every list, so that its score and the upper bound of all lists are the same sum in different orders.
+    Otherwise, the scores have few distinct values (including negative ones) for ties between documents.
+    """
+    target_docids = np.sort(rng.choice(documents, int(rng.integers(1, 4)), replace=False)).astype(np.int64)
+    posting_lists = []
+    for _ in range(terms):
+        docids = np.union1d(rng.choice(documents, int(rng.integers(1, documents)), replace=False), target_docids[:1] if targets_are_maximum else []).astype(np.int64)
+        if targets_are_maximum:
+            scores = rng.random(len(docids)) * 3
+            scores[docids == target_docids[0]] = scores.max() + rng.random()
+        else:
+            scores = rng.choice([-1.0, -0.5, 0.5, 1.0, 2.0], len(docids))
+        posting_lists.append((docids, scores))
+    return posting_lists, target_docids
+
+
+@click.command()
+@click.option("--trials", type=int, default=2000, help="The number of random queries per case.")
+@click.option("--seed", type=int, default=0, help="The seed of the random posting lists.")
+def main(trials, seed):
+    """
+    Check the ranks of the target documents of PostingListScorer against the full ranking on random posting lists,
+    including targets that hold the maximum score of every list.
+    """
+    rng = np.random.default_rng(seed)
+    for targets_are_maximum in [True, False]:
+        for trial in range(trials):
+            posting_lists, target_docids = random_posting_lists(rng, 50, int(rng.integers(1, 4)), targets_are_maximum)
+            expected = brute_force_ranks(posting_lists, target_docids)
+            actual = PostingListScorer.ranks(posting_lists, target_docids)
+            if not np.array_equal(expected, actual):
+                raise ValueError(f"Trial {trial} ranks the targets {target_docids.tolist()} at {actual.tolist()} instead of {expected.tolist()}.")
+        print(f"PostingListScorer ranks the targets of {trials} random queries as the full ranking" + (" (targets with the maximum score of every list)." if targets_are_maximum else "."))
+
+
+if __name__ == "__main__":
+    main()
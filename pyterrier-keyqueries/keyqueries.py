@@ -1,87 +1,490 @@
 #!/usr/bin/env python3
+import gzip
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
 from pathlib import Path
 from shutil import copy
 
 import click
+import numpy as np
 import pandas as pd
 import pyterrier as pt
 from ir_datasets_longeval import load
 
-# We use the tracker to monitor resource consumption etc. of the indexing and retrieval.
+from longeval_common.indexing import META_TEXT_LENGTH, IndexOptions, get_index
+from longeval_common.retrieval import normalise_query, write_run
+from longeval_common.snapshots import process_snapshots_in_parallel
+
+# We use the tracker to monitor resource consumption etc. of the indexing and retrieval, broken down into spans.
 # The tracking is optional, i.e., you can remove it or switch to an alternative such as repro_eval.
-from tirex_tracker import tracking
+from longeval_common.spans import span, tracked
 
 
-def get_index(ir_dataset, index_directory):
-    # PyTerrier needs an absolute path
-    index_directory = index_directory.resolve().absolute()
+# Keyqueries are combinations of up to KEYQUERY_MAX_LENGTH of the KEYQUERY_TERMS best terms of the previously
+# relevant documents of a query that retrieve these documents within the top KEYQUERY_DEPTH results.
+KEYQUERY_TERMS = 8
+KEYQUERY_MAX_LENGTH = 3
+KEYQUERY_DEPTH = 10
+# The number of candidates per query that are evaluated together in one batch
+KEYQUERY_BATCH_SIZE = 16
+# Marks the end of a posting list in Terrier (IterablePosting.EOL)
+POSTINGS_EOL = 2147483647
 
-    if (
-        not index_directory.exists()
-        or not (index_directory / "data.properties").exists()
-    ):
-        with tracking(export_file_path=index_directory / "index-ir-metadata.yml"):
-            # build the index
-            indexer = pt.IterDictIndexer(
-                str(index_directory), overwrite=True, meta={"docno": 100, "text": 20480}, properties={"metaindex.compressed.reverse.allow.duplicates": True}
-            )
 
-            # you can do some custom document processing here
-            docs = (
-                {"docno": i.doc_id, "text": i.default_text()}
-                for i in ir_dataset.docs_iter()
-            )
-            indexer.index(docs)
+def relevant_documents_from_prior_datasets(ir_dataset, query_texts):
+    """
+    The documents that were relevant for the (normalised) query texts in the prior snapshots,
+    as query text -> doc_id -> document text.
+    """
+    ret = {}
+    for prior_dataset in ir_dataset.get_prior_datasets() or []:
+        if not prior_dataset.has_qrels():
+            continue
 
-    return pt.IndexFactory.of(str(index_directory))
+        query_id_to_relevant_documents = {}
+        with span("qrels loading"):
+            for qrel in prior_dataset.qrels_iter():
+                if qrel.relevance > 0:
+                    query_id_to_relevant_documents.setdefault(qrel.query_id, set()).add(qrel.doc_id)
 
+        query_text_to_relevant_documents = {}
+        for query in prior_dataset.queries_iter():
+            query_text = normalise_query(query.default_text())
+            if query_text in query_texts and query.query_id in query_id_to_relevant_documents:
+                query_text_to_relevant_documents.setdefault(query_text, set()).update(query_id_to_relevant_documents[query.query_id])
 
-def process_dataset(ir_dataset, index_directory, output_directory):
-    if (output_directory / "run.txt.gz").exists():
-        return
+        doc_ids = set().union(*query_text_to_relevant_documents.values())
+        with span("doc-store reads", len(doc_ids)):
+            docs = prior_dataset.docs_store().get_many(doc_ids)
+        for query_text, doc_ids in query_text_to_relevant_documents.items():
+            for doc_id in doc_ids:
+                if doc_id in docs:
+                    ret.setdefault(query_text, {})[doc_id] = docs[doc_id].default_text()
+
+    return ret
+
+
+def keyquery_candidates(index, documents):
+    """
+    Candidate keyqueries for the previously relevant documents: all combinations of up to KEYQUERY_MAX_LENGTH
+    of the KEYQUERY_TERMS terms with the highest tf-idf in the documents. Each candidate comes with an upper
+    bound of how many of the documents it can retrieve, as a document can only be retrieved if it contains at
+    least one term of the candidate. Candidates are sorted by decreasing upper bound, then by length.
+    """
+    tokeniser = pt.java.autoclass("org.terrier.indexing.tokenisation.Tokeniser").getTokeniser()
+    stopwords = pt.java.autoclass("org.terrier.terms.Stopwords")(None)
+    stemmer = pt.java.autoclass("org.terrier.terms.PorterStemmer")()
+    lexicon = index.getLexicon()
+    number_of_documents = index.getCollectionStatistics().getNumberOfDocuments()
+
+    term_frequencies = Counter()
+    # the candidates use the unstemmed terms, the retriever applies the same term pipeline as the indexer
+    surface_forms = {}
+    document_terms = []
+    for text in documents.values():
+        terms = set()
+        for token in tokeniser.getTokens(text):
+            if stopwords.isStopword(token):
+                continue
+            term = stemmer.stem(token)
+            surface_forms.setdefault(term, token)
+            term_frequencies[term] += 1
+            terms.add(term)
+        document_terms.append(terms)
+
+    tf_idf = {}
+    for term, term_frequency in term_frequencies.items():
+        lexicon_entry = lexicon.getLexiconEntry(term)
+        if lexicon_entry is not None:
+            tf_idf[term] = term_frequency * math.log(number_of_documents / lexicon_entry.getDocumentFrequency())
+    terms = sorted(tf_idf, key=lambda i: (-tf_idf[i], i))[:KEYQUERY_TERMS]
+
+    candidates = []
+    for length in range(1, KEYQUERY_MAX_LENGTH + 1):
+        for combination in combinations(terms, length):
+            upper_bound = min(KEYQUERY_DEPTH, sum(1 for i in document_terms if i.intersection(combination)))
+            candidates.append((upper_bound, length, " ".join(surface_forms[i] for i in combination)))
+
+    return sorted(candidates, key=lambda i: (-i[0], i[1]))
+
+
+def can_beat(upper_bound, coverage, reciprocal_ranks):
+    """
+    Whether a candidate that retrieves at most upper_bound target documents can be better than the best
+    keyquery so far, which retrieves coverage target documents with the sum of reciprocal_ranks.
+    """
+    if upper_bound != coverage:
+        return upper_bound > coverage
+
+    return reciprocal_ranks < sum(1 / i for i in range(1, coverage + 1))
+
+
+def search_keyqueries(evaluate, candidates):
+    """
+    Search the best keyquery per query, i.e., the candidate that retrieves the most target documents in the
+    top KEYQUERY_DEPTH, ties are broken by the reciprocal ranks of the target documents. The candidates of all
+    queries are evaluated batch-wise by evaluate, which maps a batch of (qid, candidate) pairs to the
+    (coverage, reciprocal ranks) of the candidates. A query stops as soon as none of its remaining candidates
+    can beat its best keyquery.
+    """
+    best = {i: (0, 0.0, None) for i in candidates}
+    position = {i: 0 for i in candidates}
+    active = sorted(candidates)
+
+    while active:
+        batch = []
+        for qid in active:
+            pending = []
+            for candidate in candidates[qid][position[qid]:position[qid] + KEYQUERY_BATCH_SIZE]:
+                # candidates are sorted by decreasing upper bound, so none of the following can beat the best either
+                if not can_beat(candidate[0], best[qid][0], best[qid][1]):
+                    break
+                pending.append(candidate)
+            position[qid] = position[qid] + len(pending) if len(pending) == KEYQUERY_BATCH_SIZE else len(candidates[qid])
+            batch += [(qid, candidate[2]) for candidate in pending]
+
+        active = [i for i in active if position[i] < len(candidates[i])]
+        if not batch:
+            break
+
+        for (qid, query), quality in zip(batch, evaluate(batch)):
+            if quality > best[qid][:2]:
+                best[qid] = (*quality, query)
+
+    return {qid: i[2] for qid, i in best.items()}
+
+
+def evaluate_with_retriever(retriever, targets):
+    """
+    Evaluate candidate keyqueries by retrieving the top KEYQUERY_DEPTH results of all candidates of a batch.
+    """
+    def evaluate(batch):
+        topics = pd.DataFrame([{"qid": f"{qid}:{i}", "query": query} for i, (qid, query) in enumerate(batch)])
+        run = retriever(topics)
+        run = run[[docno in targets[batch[int(i.split(":")[1])][0]] for i, docno in zip(run["qid"], run["docno"])]]
+
+        quality = [(0, 0.0)] * len(batch)
+        for candidate_id, hits in run.groupby("qid"):
+            quality[int(candidate_id.split(":")[1])] = (len(hits), float((1 / (hits["rank"] + 1)).sum()))
+        return quality
+
+    return evaluate
+
+
+def evaluate_with_postings(scorer, targets, executor=None, threads=1):
+    """
+    Evaluate candidate keyqueries with the PostingListScorer, i.e., without a full retrieval per candidate. With an
+    executor, the candidates of a batch are partitioned across threads that share the posting lists of the scorer.
+    The candidates are stemmed and the targets looked up in the calling thread, as Terrier's stemmer keeps state
+    and the threads only need to read posting lists.
+    """
+    target_docids = {qid: scorer.docids(docnos) for qid, docnos in targets.items()}
+
+    def evaluate_partition(partition):
+        try:
+            return [scorer.score_terms(terms, target_docids[qid]) for qid, terms in partition]
+        finally:
+            # threads of the executor attach to the JVM on their first call, they must not stay attached
+            from jnius import detach
+            detach()
+
+    def evaluate(batch):
+        batch = [(qid, scorer.terms(query)) for qid, query in batch]
+        if executor is None or threads < 2 or len(batch) < 2:
+            return [scorer.score_terms(terms, target_docids[qid]) for qid, terms in batch]
+
+        size = math.ceil(len(batch) / threads)
+        partitions = [batch[i:i + size] for i in range(0, len(batch), size)]
+        return [quality for qualities in executor.map(evaluate_partition, partitions) for quality in qualities]
+
+    return evaluate
+
+
+# The parameters of BM25 in Terrier
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Posting lists of terms that are scored with BM25, kept for the candidates of all queries of a snapshot
+POSTING_LIST_CACHE_SIZE = 10000
+# Relative tolerance of the comparison of score bounds that are summed in different orders
+SCORE_TOLERANCE = 1e-9
+
+
+class PostingListScorer:
+    """
+    Scores candidate keyqueries with BM25 directly on the posting lists of the candidate terms. The rank of
+    a target document is one plus the number of documents with a higher score, so a candidate is accepted or
+    rejected without materialising a ranking. As in MaxScore, only documents that occur in one of the
+    essential posting lists are scored, i.e., the lists whose maximum scores together can exceed the score
+    of a target document. Scores are the same as the ones of Terrier's BM25 for queries without duplicate terms.
+    """
+    def __init__(self, index):
+        collection_statistics = index.getCollectionStatistics()
+        self.number_of_documents = collection_statistics.getNumberOfDocuments()
+        self.average_document_length = collection_statistics.getAverageDocumentLength()
+        self.lexicon = index.getLexicon()
+        self.inverted_index = index.getInvertedIndex()
+        self.meta_index = index.getMetaIndex()
+        self.stopwords = pt.java.autoclass("org.terrier.terms.Stopwords")(None)
+        self.stemmer = pt.java.autoclass("org.terrier.terms.PorterStemmer")()
+        self.posting_lists = OrderedDict()
+        # guards the posting lists, which are shared by the threads of evaluate_with_postings
+        self.lock = threading.Lock()
+        self.docid_of_docno = {}
+
+    def docid(self, docno):
+        if docno not in self.docid_of_docno:
+            self.docid_of_docno[docno] = self.meta_index.getDocument("docno", docno)
+        return self.docid_of_docno[docno]
+
+    def docids(self, docnos):
+        """
+        The sorted docids of the docnos that are in the index.
+        """
+        return np.array(sorted(i for i in map(self.docid, docnos) if i >= 0), dtype=np.int64)
 
-    index = get_index(ir_dataset, index_directory)
-    with tracking(export_file_path=output_directory / "retrieval-ir-metadata.yml"):
-        bm25 = pt.terrier.Retriever(index, wmodel="BM25")
+    def posting_list(self, term):
+        """
+        The sorted docids of the posting list of the term together with their BM25 scores.
+        """
+        with self.lock:
+            if term in self.posting_lists:
+                self.posting_lists.move_to_end(term)
+                return self.posting_lists[term]
 
-        # potentially do some query processing
-        topics = pd.DataFrame(
-            [
-                {"qid": i.query_id, "query": i.default_text()}
-                for i in ir_dataset.queries_iter()
-            ]
-        )
+        docids, term_frequencies, document_lengths = [], [], []
+        lexicon_entry = self.lexicon.getLexiconEntry(term)
+        if lexicon_entry is not None:
+            postings = self.inverted_index.getPostings(lexicon_entry)
+            while postings.next() != POSTINGS_EOL:
+                docids.append(postings.getId())
+                term_frequencies.append(postings.getFrequency())
+                document_lengths.append(postings.getDocumentLength())
+            postings.close()
 
-        # PyTerrier needs to use pre-tokenized queries
-        tokeniser = pt.java.autoclass(
-            "org.terrier.indexing.tokenisation.Tokeniser"
-        ).getTokeniser()
+        document_frequency = len(docids)
+        term_frequencies = np.array(term_frequencies, dtype=np.float64)
+        k = BM25_K1 * ((1 - BM25_B) + BM25_B * np.array(document_lengths, dtype=np.float64) / self.average_document_length)
+        idf = math.log2((self.number_of_documents - document_frequency + 0.5) / (document_frequency + 0.5))
+        scores = idf * (BM25_K1 + 1) * term_frequencies / (k + term_frequencies)
 
-        topics["query"] = topics["query"].apply(
-            lambda i: " ".join(tokeniser.getTokens(i))
-        )
+        order = np.argsort(docids, kind="stable")
+        posting_list = (np.array(docids, dtype=np.int64)[order], scores[order])
+        with self.lock:
+            self.posting_lists[term] = posting_list
+            if len(self.posting_lists) > POSTING_LIST_CACHE_SIZE:
+                self.posting_lists.popitem(last=False)
 
-        run = bm25(topics)
-        pt.io.write_results(run, output_directory / "run.txt.gz")
-        copy(index_directory / "index-ir-metadata.yml", output_directory / "index-ir-metadata.yml")
+        return posting_list
+
+    def terms(self, query):
+        return set(self.stemmer.stem(i) for i in query.split() if not self.stopwords.isStopword(i))
+
+    @staticmethod
+    def lookup(posting_list, docids):
+        docids_of_term, scores = posting_list
+        positions = np.minimum(np.searchsorted(docids_of_term, docids), len(docids_of_term) - 1)
+        return np.where(docids_of_term[positions] == docids, scores[positions], 0.0) if len(docids_of_term) else np.zeros(len(docids))
+
+    @staticmethod
+    def contains(posting_list, docids):
+        docids_of_term = posting_list[0]
+        positions = np.minimum(np.searchsorted(docids_of_term, docids), len(docids_of_term) - 1)
+        return docids_of_term[positions] == docids
+
+    @staticmethod
+    def ranks(posting_lists, target_docids):
+        """
+        The ranks of the target documents for a query with the posting lists, targets that match no query term
+        are left out. As in Terrier, documents are ranked by decreasing score and ties by docid.
+        """
+        posting_lists = [i for i in posting_lists if len(i[0])]
+        if not posting_lists or not len(target_docids):
+            return np.zeros(0, dtype=np.int64)
+
+        # documents that match no query term are not retrieved, documents that match one are retrieved even with a
+        # score <= 0, as the idf of BM25 is negative for terms that occur in more than half of the documents
+        contains_target = [PostingListScorer.contains(i, target_docids) for i in posting_lists]
+        target_docids = target_docids[np.logical_or.reduce(contains_target)]
+        if not len(target_docids):
+            return np.zeros(0, dtype=np.int64)
+        target_scores = sum(PostingListScorer.lookup(i, target_docids) for i in posting_lists)
+
+        # lists are non-essential as long as the sum of their positive maximum scores is below the lowest target
+        # score, a document with the same score could still rank above a target with a higher docid. The bounds
+        # and the target scores are summed in different orders, so the bound must stay below the lowest target
+        # score by more than their rounding errors, and a list that contains a target is always essential.
+        order = sorted(range(len(posting_lists)), key=lambda i: posting_lists[i][1].max())
+        upper_bounds = np.cumsum([max(posting_lists[i][1].max(), 0.0) for i in order])
+        lowest_target_score = target_scores.min() - SCORE_TOLERANCE * max(abs(target_scores.min()), 1.0)
+        first_essential = int(np.searchsorted(upper_bounds, lowest_target_score, side="left"))
+        essential = [posting_lists[i] for position, i in enumerate(order) if position >= first_essential or contains_target[i].any()]
+
+        docids = np.unique(np.concatenate([i[0] for i in essential]))
+        scores = sum(PostingListScorer.lookup(i, docids) for i in posting_lists)
+        position = np.empty(len(docids), dtype=np.int64)
+        position[np.lexsort((docids, -scores))] = np.arange(len(docids))
+
+        return 1 + position[np.searchsorted(docids, target_docids)]
+
+    def score(self, query, target_docnos):
+        """
+        The number of target documents that the query ranks within the top KEYQUERY_DEPTH and the sum of
+        their reciprocal ranks.
+        """
+        return self.score_terms(self.terms(query), self.docids(target_docnos))
+
+    def score_terms(self, terms, target_docids):
+        """
+        score for the stemmed terms of a query and the docids of its targets, it only reads posting lists.
+        """
+        posting_lists = [self.posting_list(i) for i in sorted(terms)]
+        ranks = self.ranks(posting_lists, target_docids)
+        ranks = ranks[ranks <= KEYQUERY_DEPTH]
+
+        return (len(ranks), float((1 / ranks).sum()))
+
+
+def read_keyqueries(cache_file):
+    if not cache_file.exists():
+        return {}
+    with gzip.open(cache_file, "rt") as f:
+        return json.load(f)
+
+
+def write_keyqueries(keyqueries, cache_file):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    with gzip.open(tmp_file, "wt") as f:
+        json.dump(keyqueries, f)
+    os.replace(tmp_file, cache_file)
+
+
+def get_keyqueries(ir_dataset, index, index_directory, threads=1, keyquery_evaluation="postings", dataset=None):
+    """
+    The keyqueries of the queries of a snapshot against its index, as normalised query text -> keyquery,
+    for all queries that had relevant documents in a prior snapshot. Keyqueries are cached per dataset id and
+    snapshot, so that re-runs only search keyqueries for queries that were not searched before.
+    """
+    # snapshots of different datasets share their name but not their qrels, e.g., snapshot-1/train/raw and
+    # snapshot-1/train/dctr of longeval-sci-2026
+    dataset_key = hashlib.sha256(str(dataset).encode()).hexdigest()[:16]
+    cache_file = index_directory.resolve().parent / "keyqueries" / f"{ir_dataset.get_snapshot()}-{dataset_key}.json.gz"
+    keyqueries = read_keyqueries(cache_file)
+
+    query_texts = set(normalise_query(i.default_text()) for i in ir_dataset.queries_iter()) - keyqueries.keys()
+    if not query_texts:
+        return keyqueries
+
+    documents = relevant_documents_from_prior_datasets(ir_dataset, query_texts)
+    meta_index = index.getMetaIndex()
+
+    targets, candidates = {}, {}
+    with span("keyquery candidates", len(documents)):
+        for qid, query_text in enumerate(sorted(documents)):
+            # only documents that are still in the snapshot can be retrieved
+            targets[qid] = set(i for i in documents[query_text] if meta_index.getDocument("docno", i) >= 0)
+            if targets[qid]:
+                candidates[qid] = keyquery_candidates(index, {i: documents[query_text][i] for i in targets[qid]})
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        if keyquery_evaluation == "postings":
+            evaluate = evaluate_with_postings(PostingListScorer(index), targets, executor, threads)
+        else:
+            evaluate = evaluate_with_retriever(pt.terrier.Retriever(index, wmodel="BM25", num_results=KEYQUERY_DEPTH, threads=threads), targets)
+        with span("keyquery search", len(candidates)):
+            best = search_keyqueries(evaluate, candidates)
+
+    keyqueries.update({i: None for i in query_texts})
+    keyqueries.update({query_text: best.get(qid) for qid, query_text in enumerate(sorted(documents))})
+    write_keyqueries(keyqueries, cache_file)
+
+    return keyqueries
+
+
+def expand_with_keyqueries(keyqueries):
+    """
+    Rewrite the (tokenised) queries by appending the keyquery of their normalised query text.
+    """
+    def _expand(queries, query_texts):
+        return [f"{query} {keyqueries[text]}" if keyqueries.get(text) else query for query, text in zip(queries, map(normalise_query, query_texts))]
+
+    return _expand
+
+
+def process_dataset(ir_dataset, index_directory, output_directory, index_options=IndexOptions(), *, dataset=None, chunk_size=None, threads=1, use_keyqueries=False, keyquery_evaluation="postings"):
+    if (output_directory / "run.txt.gz").exists():
+        return
+
+    index = get_index(ir_dataset, index_directory, index_options, dataset=dataset)
+    try:
+        with tracked(output_directory / "retrieval-ir-metadata.yml", "retrieval run"):
+            bm25 = pt.terrier.Retriever(index, wmodel="BM25", threads=threads)
+            keyqueries = get_keyqueries(ir_dataset, index, index_directory, threads=threads, keyquery_evaluation=keyquery_evaluation, dataset=dataset) if use_keyqueries else {}
+
+            # the run depends on the keyqueries, which can change with the keyquery cache
+            run_options = {"wmodel": "BM25", "keyqueries": keyqueries}
+            write_run(ir_dataset, bm25, index_directory, output_directory, chunk_size, expand_with_keyqueries(keyqueries), run_options)
+            copy(index_directory / "index-ir-metadata.yml", output_directory / "index-ir-metadata.yml")
+    finally:
+        # close the index of this snapshot before the index of the next snapshot is opened
+        index.close()
 
 
 @click.command()
 @click.option("--dataset", type=str, help="The dataset id or a local directory.")
 @click.option("--output", type=Path, required=True, help="The output directory.")
 @click.option("--index", type=Path, required=True, help="The index directory.")
-def main(dataset, output, index):
+@click.option("--workers", type=int, default=1, help="The number of snapshots that are processed in parallel.")
+@click.option("--shards", type=int, default=1, help="The number of partial indexes that are built in parallel per snapshot.")
+@click.option("--chunk-size", type=int, default=None, help="Retrieve and write the run in chunks of this many queries. An interrupted run resumes at the last complete chunk.")
+@click.option("--threads", type=int, default=1, help="The number of threads that retrieve the queries of a snapshot from one shared index and that evaluate the candidate keyqueries.")
+@click.option("--index-loading", type=click.Choice(["default", "memory", "disk"]), default="default", help="Load the index structures with the defaults of PyTerrier, into memory, or read them from disk on demand.")
+@click.option("--meta-text/--no-meta-text", default=True, help="Store the document text in the meta index of new indexes. The retrieval does not need it.")
+@click.option("--corpus-cache", type=Path, default=None, help="Convert the documents of every snapshot once into a columnar file in this directory and index from it instead of parsing the corpus again.")
+@click.option("--prefetch-workers", type=int, default=0, help="The number of worker processes that parse and prepare the documents ahead of the indexer. More than one worker requires --corpus-cache. By default, the documents are parsed by the indexing process itself.")
+@click.option("--normalise-text", is_flag=True, help="Index the document text with NFKC unicode normalisation and collapsed whitespace.")
+@click.option("--truncate-text", is_flag=True, help=f"Index only the first {META_TEXT_LENGTH} characters of a document, the length of the text in the meta index.")
+@click.option("--keyqueries/--no-keyqueries", "use_keyqueries", default=False, help="Expand queries with keyqueries for their previously relevant documents. Disabled by default.")
+@click.option("--keyquery-evaluation", type=click.Choice(["postings", "retrieval"]), default="postings", help="Evaluate candidate keyqueries on the posting lists of their terms or with a full retrieval.")
+def main(dataset, output, index, workers, shards, chunk_size, threads, index_loading, meta_text, corpus_cache, prefetch_workers, normalise_text, truncate_text, use_keyqueries, keyquery_evaluation):
+    if prefetch_workers and shards > 1:
+        raise click.UsageError("--shards feeds the documents to the index shards itself, so it can not be combined with --prefetch-workers.")
+    if prefetch_workers > 1 and not corpus_cache:
+        raise click.UsageError("Without --corpus-cache, every prefetching worker would parse all documents, so use --prefetch-workers 1 or add --corpus-cache.")
+
     ir_dataset = load(dataset)
     sub_collections = [ir_dataset] if not ir_dataset.get_datasets() else ir_dataset.get_datasets()
 
-    for snapshot in sub_collections:
-        process_dataset(snapshot, index / snapshot.get_snapshot(), output / snapshot.get_snapshot())
+    index_options = IndexOptions(
+        shards=shards, index_loading=index_loading, meta_text=meta_text, corpus_cache=corpus_cache,
+        prefetch_workers=prefetch_workers, normalise_text=normalise_text, truncate_text=truncate_text,
+    )
+    options = {
+        "index_options": index_options, "dataset": dataset, "chunk_size": chunk_size, "threads": threads,
+        "use_keyqueries": use_keyqueries, "keyquery_evaluation": keyquery_evaluation,
+    }
+
+    failed = {}
+    if workers > 1:
+        failed = process_snapshots_in_parallel(process_dataset, dataset, sub_collections, index, output, workers, options)
+    else:
+        for snapshot in sub_collections:
+            process_dataset(snapshot, index / snapshot.get_snapshot(), output / snapshot.get_snapshot(), **options)
 
     # The ir-metadata description of your approach
     ir_metadata = Path(__file__).parent / "ir-metadata.yml"
 
     copy(ir_metadata, output / "ir-metadata.yml")
 
+    if failed:
+        raise click.ClickException(f"Processing failed for the snapshots {', '.join(sorted(failed))}.")
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
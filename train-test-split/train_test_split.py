@@ -1,38 +1,73 @@
-import pandas as pd
+import gzip
+from itertools import islice
+from pathlib import Path
 
-from sklearn.model_selection import train_test_split
+import click
+import numpy as np
+import pandas as pd
 from ir_datasets_longeval import load
 
+from longeval_common.corpus_cache import get_corpus
 
-files = {}
-
-train_collection = load('longeval-sci/2024-11/train')
+# A quarter of the docs and queries is in both splits, the remaining ones are split in half
+SHARED = 0.25
+FIRST = SHARED + (1 - SHARED) / 2
+SPLITS = {
+    'train': lambda position: position < FIRST,
+    'test': lambda position: (position < SHARED) | (position >= FIRST),
+}
 
-queries = list(train_collection.queries_iter())
-documents = [d.doc_id for d in train_collection.docs_iter()]
-qrels = list(train_collection.qrels_iter())
 
-d_both, d_remaining = train_test_split(documents, train_size=0.25)
-d_first, d_second = train_test_split(d_remaining, train_size=0.5)
+def split_positions(ids, seed):
+    """
+    A stable position in [0, 1) for each id, the same id always gets the same position for the same seed
+    """
+    hashes = pd.util.hash_pandas_object(pd.Series(ids).astype(str), index=False, hash_key=str(seed).zfill(16)).to_numpy()
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
 
-files['docs_train'] = pd.DataFrame({'doc_id': d_both + d_first})
-files['docs_test'] = pd.DataFrame({'doc_id': d_both + d_second})
 
-q_both, q_remaining = train_test_split(queries, train_size=0.25)
-q_first, q_second = train_test_split(q_remaining, train_size=0.5)
+def write_splits(records, name, in_splits, output, chunk_size):
+    """
+    Stream the records in chunks into one gzipped CSV file per split, in_splits returns the mask of each split for a chunk
+    """
+    files = {split: gzip.open(output / f'{name}_{split}.csv.gz', 'wt') for split in SPLITS}
+    try:
+        header = True
+        while chunk := list(islice(records, chunk_size)):
+            df = pd.DataFrame(chunk)
+            for split, mask in in_splits(df).items():
+                df[mask].to_csv(files[split], header=header, index=False)
+            header = False
+    finally:
+        for f in files.values():
+            f.close()
 
-files['queries_train'] = pd.DataFrame(q_both + q_first)
-files['queries_test'] = pd.DataFrame(q_both + q_second)
 
-docids_train = set(files['docs_train']['doc_id'])
-docids_test = set(files['docs_test']['doc_id'])
+@click.command()
+@click.option('--dataset', type=str, default='longeval-sci/2024-11/train', help='The dataset id or a local directory that is split.')
+@click.option('--seed', type=click.IntRange(0, 10 ** 16 - 1), default=0, help='The seed of the split, the same seed always gives the same split.')
+@click.option('--chunk-size', type=int, default=100000, help='The number of docs, queries, or qrels that are processed at once.')
+@click.option('--corpus-cache', type=Path, default=None, help='Read the doc_ids from the columnar corpus cache in this directory instead of parsing the corpus, it is converted on first use.')
+@click.option('--output', type=Path, default=Path('.'), help='The output directory.')
+def main(dataset, seed, chunk_size, corpus_cache, output):
+    train_collection = load(dataset)
+    output.mkdir(parents=True, exist_ok=True)
 
-qids_train = set(files['queries_train']['query_id'])
-qids_test = set(files['queries_test']['query_id'])
+    def in_splits(*columns):
+        def ret(df):
+            positions = [split_positions(df[column], seed) for column in columns]
+            return {split: np.logical_and.reduce([in_split(i) for i in positions]) for split, in_split in SPLITS.items()}
+        return ret
 
+    if corpus_cache:
+        docs = get_corpus(train_collection, corpus_cache).iter_dicts(['doc_id'])
+    else:
+        docs = ({'doc_id': d.doc_id} for d in train_collection.docs_iter())
+    write_splits(docs, 'docs', in_splits('doc_id'), output, chunk_size)
+    write_splits(train_collection.queries_iter(), 'queries', in_splits('query_id'), output, chunk_size)
+    # a qrel is in a split if both its query and its doc are in the split
+    write_splits(train_collection.qrels_iter(), 'qrels', in_splits('query_id', 'doc_id'), output, chunk_size)
 
-files['qrels_train'] = pd.DataFrame([qrel for qrel in qrels if qrel.doc_id in docids_train and qrel.query_id in qids_train])
-files['qrels_test'] = pd.DataFrame([qrel for qrel in qrels if qrel.doc_id in docids_test and qrel.query_id in qids_test])
 
-for filename, df in files.items():
-    df.to_csv(f'{filename}.csv.gz', index=False, compression='gzip')
+if __name__ == '__main__':
+    main()